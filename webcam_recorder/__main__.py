@@ -8,10 +8,25 @@ from .video_view import RecordView
 
 
 if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Record video from cameras.')
+    parser.add_argument('--playback', nargs='?', const='', metavar='VIDEO',
+                        help='Step through recordings frame by frame '
+                        '(optionally opening VIDEO) instead of recording.')
+    args = parser.parse_args()
+
     GObject.threads_init()
     Gst.init(None)
 
-    view = RecordView()
+    if args.playback is None:
+        view = RecordView()
+    else:
+        from .view import PlaybackView
+
+        view = PlaybackView()
     view.prepare_ui()
+    if args.playback:
+        view.on_selected(args.playback)
     view.widget.connect('destroy', lambda *args: view.hide_and_quit())
     view.show_and_run()
@@ -0,0 +1,310 @@
+'''
+Asynchronous control interface for camera pipelines.
+
+Blocking GStreamer operations (building pipelines, state changes, waiting for
+the muxer to finalize a recording) run in worker threads, so many cameras may
+be started, switched or stopped concurrently.  Each operation returns a
+`PipelineFuture`, e.g.:
+
+    cameras = [AsyncPipelineManager() for i in range(10)]
+    futures = [c.start(xid_i, config_i, record_path=path_i)
+               for c, xid_i, config_i, path_i in ...]
+    for future in futures:
+        future.result(timeout=10)
+    ...
+    for future in [c.stop() for c in cameras]:
+        future.result()
+
+State changes and errors are bridged from the GStreamer bus as they are
+posted (i.e., without polling) and are delivered to callbacks registered with
+`AsyncPipelineManager.connect()`.
+
+By default, future and event callbacks are invoked from the thread that
+completed the operation or posted the message.  With `main_loop=True`,
+callbacks are instead invoked from the GLib main loop (e.g., of the GTK
+application), so callbacks may safely update the user interface.  __NB__ In
+that case, callbacks are only invoked while a GLib main loop is running
+(e.g., `Gtk.main()` or `GLib.MainLoop().run()`).  Waiting on a future (e.g.,
+`future.result()`) does not require a main loop.
+'''
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import GLib, Gst
+
+from .caps import get_configs, get_video_sources, merge_device_configs
+from .pipeline import PipelineManager
+
+
+PipelineEvent = namedtuple('PipelineEvent', 'type source data timestamp')
+
+
+class PipelineError(Exception):
+    pass
+
+
+class PipelineTimeout(PipelineError):
+    pass
+
+
+def invoke(callback, args, main_loop=False):
+    '''
+    Invoke `callback(*args)` from the GLib main loop if `main_loop` is
+    `True` (i.e., only once a main loop runs), otherwise from the calling
+    thread.
+    '''
+    if main_loop:
+        def _callback():
+            callback(*args)
+            # Run only once.
+            return False
+        GLib.idle_add(_callback)
+    else:
+        callback(*args)
+
+
+class PipelineFuture(object):
+    '''
+    Result of an asynchronous operation.
+    '''
+    def __init__(self, main_loop=False):
+        self.main_loop = main_loop
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        '''
+        Wait (up to `timeout` seconds) for the operation to complete and
+        return its result, or raise its exception.
+        '''
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise PipelineTimeout('Operation did not complete within %s s.' %
+                                  timeout)
+        return self._exception
+
+    def add_done_callback(self, callback):
+        '''
+        Call `callback(future)` once the operation completes (immediately if
+        it already has).
+        '''
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        invoke(callback, (self, ), self.main_loop)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            invoke(callback, (self, ), self.main_loop)
+
+
+def run_async(func, args=(), kwargs=None, main_loop=False):
+    '''
+    Run `func(*args, **kwargs)` in a worker thread.
+
+    Returns `PipelineFuture` for the return value of `func`.
+    '''
+    future = PipelineFuture(main_loop)
+
+    def _run():
+        try:
+            result = func(*args, **(kwargs or {}))
+        except Exception as exception:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    thread = threading.Thread(target=_run)
+    thread.daemon = True
+    thread.start()
+    return future
+
+
+class AsyncPipelineManager(object):
+    '''
+    Asynchronous wrapper around a `PipelineManager` (i.e., one camera).
+
+    Arguments
+    ---------
+
+     - `manager`: `PipelineManager` to control (default: new manager).
+     - `main_loop`: If `True`, invoke callbacks from the GLib main loop,
+       which must be running (see module documentation).
+    '''
+    def __init__(self, manager=None, main_loop=False):
+        self.manager = manager if manager is not None else PipelineManager()
+        # Connect bus handler before each pipeline is started, so no message
+        # (e.g., an error while starting) is missed.
+        self.manager.on_created = self._attach
+        self.main_loop = main_loop
+        self._subscribers = {}
+        self._subscriber_id = 0
+        self._handler = None
+        self._playing = threading.Event()
+        self._error = None
+        # Serialize operations on the manager.
+        self._lock = threading.Lock()
+
+    @property
+    def pipeline(self):
+        return self.manager.pipeline
+
+    def start(self, xid, device_config, record_path=None, timeout=5.,
+              **record_kwargs):
+        '''
+        Start pipeline.
+
+        Returns `PipelineFuture`, completed once the pipeline reaches the
+        `PLAYING` state.  The future raises `PipelineError` if an error is
+        posted by the pipeline, or `PipelineTimeout` if the pipeline does not
+        start within `timeout` seconds.
+        '''
+        return self.switch_config(xid, device_config, record_path=record_path,
+                                  timeout=timeout, **record_kwargs)
+
+    def switch_config(self, xid, device_config, record_path=None, timeout=5.,
+                      **record_kwargs):
+        '''
+        Stop the active pipeline (if any, finalizing any recording) and start
+        a pipeline for `device_config` (see `start()`).
+        '''
+        def _switch():
+            with self._lock:
+                self._playing.clear()
+                self._error = None
+                self.manager.set_config(xid, device_config,
+                                        record_path=record_path,
+                                        **record_kwargs)
+                if not self._playing.wait(timeout):
+                    raise PipelineTimeout('Pipeline did not start within %s '
+                                          's.' % timeout)
+                if self._error is not None:
+                    raise PipelineError(self._error)
+
+        return run_async(_switch, main_loop=self.main_loop)
+
+    def stop(self):
+        '''
+        Stop the active pipeline.
+
+        Returns `PipelineFuture`, completed once any recording is finalized.
+        '''
+        def _stop():
+            with self._lock:
+                self.manager.stop()
+                self._detach()
+
+        return run_async(_stop, main_loop=self.main_loop)
+
+    def connect(self, callback):
+        '''
+        Call `callback(event)` with a `PipelineEvent` for each state change,
+        warning, error and end-of-stream message of the pipeline.
+
+        Returns identifier to pass to `disconnect()`.
+        '''
+        self._subscriber_id += 1
+        self._subscribers[self._subscriber_id] = callback
+        return self._subscriber_id
+
+    def disconnect(self, subscriber_id):
+        self._subscribers.pop(subscriber_id, None)
+
+    def _attach(self, pipeline):
+        # Called by the manager before the pipeline is started.  Pipelines
+        # may be reused (e.g., from a `PipelinePool`), so only the
+        # active pipeline has a handler connected.
+        self._detach()
+        bus = pipeline.bus
+        # Sync messages are emitted from the thread posting the message, so
+        # no GLib main loop is required.
+        bus.enable_sync_message_emission()
+        handler_id = bus.connect('sync-message', self._on_message,
+                                 pipeline.pipeline)
+        self._handler = bus, handler_id
+
+    def _detach(self):
+        if self._handler is not None:
+            bus, handler_id = self._handler
+            bus.disconnect(handler_id)
+            self._handler = None
+
+    def _on_message(self, bus, msg, gst_pipeline):
+        if msg.type == Gst.MessageType.STATE_CHANGED:
+            if msg.src != gst_pipeline:
+                return
+            old, new, pending = msg.parse_state_changed()
+            data = new.value_nick
+        elif msg.type == Gst.MessageType.ERROR:
+            error, debug = msg.parse_error()
+            data = error.message
+        elif msg.type == Gst.MessageType.WARNING:
+            warning, debug = msg.parse_warning()
+            data = warning.message
+        elif msg.type == Gst.MessageType.EOS:
+            data = None
+        else:
+            return
+        self._dispatch(PipelineEvent(Gst.MessageType.get_name(msg.type),
+                                     msg.src.get_name(), data, time.time()))
+
+    def _dispatch(self, event):
+        if event.type == 'state-changed' and event.data == 'playing':
+            self._playing.set()
+        elif event.type == 'error':
+            self._error = event.data
+            self._playing.set()
+        for callback in list(self._subscribers.values()):
+            invoke(callback, (event, ), self.main_loop)
+
+
+def probe_devices(main_loop=False):
+    '''
+    Probe all video devices concurrently.
+
+    Returns `PipelineFuture` for a `pandas.DataFrame` in the format of
+    `caps.get_device_configs()`.
+    '''
+    def _get_configs(device):
+        df_device_i = get_configs(device)
+        df_device_i.insert(0, 'device', str(device))
+        return df_device_i
+
+    def _probe():
+        devices = get_video_sources()
+        pool = ThreadPool(max(1, len(devices)))
+        try:
+            frames = pool.map(_get_configs, devices)
+        finally:
+            pool.close()
+            pool.join()
+        return merge_device_configs(frames)
+
+    return run_async(_probe, main_loop=main_loop)
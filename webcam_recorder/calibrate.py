@@ -0,0 +1,327 @@
+'''
+Quality-calibrated encode bit rates.
+
+Rather than selecting the bit rate from the frame height alone (see
+`caps.get_bitrate()`), a short sample is captured from each camera mode and
+encoded at several bit rates.  Each encoded sample is decoded and compared to
+the source frames (luma plane, PSNR and SSIM), and the lowest bit rate
+meeting the target quality is stored in a cache, keyed by device and mode.
+
+`RecordPipeline` (and `PipelineManager`) use the calibrated bit rate of a
+mode, if available.
+
+Usage:
+
+    python -m webcam_recorder.calibrate [--target-ssim 0.95] [--duration 2]
+'''
+from __future__ import division
+import threading
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+import numpy as np
+import pandas as pd
+from path_helpers import path
+
+from .caps import get_video_source, get_caps_str
+from .snapshot import sample_to_frame
+
+
+#: Default calibration cache file.
+CACHE_PATH = path('~/.webcam-recorder/bitrates.h5').expanduser()
+
+#: Key of calibrated bit rates in cache file.
+CACHE_KEY = '/bitrates'
+
+#: Columns identifying a camera mode.
+MODE_COLUMNS = ['device', 'format', 'width', 'height', 'framerate_numerator',
+                'framerate_denominator']
+
+#: Default candidate bit rates (bits/second).
+BITRATES = (np.array([.25, .5, 1, 2, 4, 8, 16]) * (1 << 20)).astype(int)
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def get_mode_key(device_config):
+    return tuple(str(device_config[c]) if c in ('device', 'format') else
+                 int(device_config[c]) for c in MODE_COLUMNS)
+
+
+def read_cache(cache_path=None):
+    '''
+    Return calibrated bit rates stored in cache, one row per mode (empty if
+    cache does not exist).
+
+    The cache is only re-read from disk if it was modified.
+    '''
+    cache_path = path(cache_path or CACHE_PATH)
+    mtime = cache_path.getmtime() if cache_path.isfile() else None
+    with _cache_lock:
+        cached = _cache.get(cache_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        if mtime is None:
+            df_cache = pd.DataFrame(columns=MODE_COLUMNS + ['bitrate'])
+        else:
+            df_cache = pd.read_hdf(str(cache_path), CACHE_KEY)
+        _cache[cache_path] = mtime, df_cache
+    return df_cache
+
+
+def write_cache(df_cache, cache_path=None):
+    cache_path = path(cache_path or CACHE_PATH)
+    if not cache_path.parent.isdir():
+        cache_path.parent.makedirs()
+    df_cache.to_hdf(str(cache_path), CACHE_KEY, format='t', data_columns=True)
+
+
+def get_calibrated_bitrate(device_config, cache_path=None):
+    '''
+    Return calibrated bit rate (bits/second) for the mode of
+    `device_config`, or `None` if the mode has not been calibrated.
+    '''
+    if device_config is None:
+        return None
+    df_cache = read_cache(cache_path)
+    if not df_cache.shape[0]:
+        return None
+    key = get_mode_key(device_config)
+    match = np.logical_and.reduce([df_cache[c].values == v
+                                   for c, v in zip(MODE_COLUMNS, key)])
+    if not match.any():
+        return None
+    return int(df_cache.bitrate.values[match][-1])
+
+
+def store_bitrate(device_config, bitrate, cache_path=None):
+    df_cache = read_cache(cache_path)
+    key = get_mode_key(device_config)
+    df_cache = df_cache[~np.logical_and.reduce([df_cache[c].values == v
+                                                for c, v in zip(MODE_COLUMNS,
+                                                                key)])]
+    row = pd.DataFrame([key + (int(bitrate), )],
+                       columns=MODE_COLUMNS + ['bitrate'])
+    write_cache(pd.concat([df_cache, row], ignore_index=True), cache_path)
+
+
+def get_luma(sample):
+    '''
+    Return luma (Y) plane of `I420` frame sample as `numpy.ndarray`.
+    '''
+    data, video_info = sample_to_frame(sample)
+    stride = video_info.stride[0]
+    offset = video_info.offset[0]
+    return (data[offset:offset + video_info.height * stride]
+            .reshape(video_info.height, stride)[:, :video_info.width])
+
+
+def capture_sample(device_config, duration=2.):
+    '''
+    Return list of `I420` frame samples captured from the device of
+    `device_config` for `duration` seconds.
+    '''
+    pipeline = Gst.Pipeline()
+    src = get_video_source(device_config['device'])
+    filter_ = Gst.ElementFactory.make('capsfilter', None)
+    filter_.set_property('caps', Gst.Caps(get_caps_str(device_config)))
+    convert = Gst.ElementFactory.make('videoconvert', None)
+    i420_filter = Gst.ElementFactory.make('capsfilter', None)
+    i420_filter.set_property('caps', Gst.Caps('video/x-raw,format=I420'))
+    appsink = Gst.ElementFactory.make('appsink', None)
+    appsink.set_property('sync', False)
+    elements = (src, filter_, convert, i420_filter, appsink)
+    for e in elements:
+        pipeline.add(e)
+    for i, j in zip(elements[:-1], elements[1:]):
+        i.link(j)
+
+    count = max(1, int(round(duration * device_config['framerate'])))
+    pipeline.set_state(Gst.State.PLAYING)
+    try:
+        samples = []
+        for i in range(count):
+            sample = appsink.emit('pull-sample')
+            if sample is None:
+                break
+            samples.append(sample)
+    finally:
+        pipeline.set_state(Gst.State.NULL)
+    if not samples:
+        raise IOError('No frames captured from %s.' % device_config['device'])
+    return samples
+
+
+def encode_decode(samples, bitrate, framerate=30):
+    '''
+    Encode frame samples at `bitrate` (bits/second) and decode them again.
+
+    Returns `(luma, encoded_bytes)`, where `luma` is a list of decoded luma
+    planes (height x width arrays).
+    '''
+    caps = samples[0].get_caps().copy()
+    pipeline = Gst.Pipeline()
+    appsrc = Gst.ElementFactory.make('appsrc', None)
+    appsrc.set_property('caps', caps)
+    appsrc.set_property('format', Gst.Format.TIME)
+    encoder = Gst.ElementFactory.make('avenc_mpeg4', None)
+    encoder.set_property('bitrate', int(bitrate))
+    encoder.set_property('bitrate-tolerance', 500 << 10)
+    decoder = Gst.ElementFactory.make('avdec_mpeg4', None)
+    convert = Gst.ElementFactory.make('videoconvert', None)
+    i420_filter = Gst.ElementFactory.make('capsfilter', None)
+    i420_filter.set_property('caps', Gst.Caps('video/x-raw,format=I420'))
+    appsink = Gst.ElementFactory.make('appsink', None)
+    appsink.set_property('sync', False)
+    elements = (appsrc, encoder, decoder, convert, i420_filter, appsink)
+    for e in elements:
+        pipeline.add(e)
+    for i, j in zip(elements[:-1], elements[1:]):
+        i.link(j)
+
+    encoded = [0]
+
+    def _count_bytes(pad, info):
+        encoded[0] += info.get_buffer().get_size()
+        return Gst.PadProbeReturn.OK
+
+    encoder.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER,
+                                            _count_bytes)
+    pipeline.set_state(Gst.State.PLAYING)
+    try:
+        frame_duration = int(Gst.SECOND / framerate)
+        for i, sample in enumerate(samples):
+            buf = sample.get_buffer().copy()
+            buf.pts = i * frame_duration
+            buf.duration = frame_duration
+            appsrc.emit('push-buffer', buf)
+        appsrc.emit('end-of-stream')
+        luma = []
+        while True:
+            sample = appsink.emit('pull-sample')
+            if sample is None:
+                break
+            luma.append(get_luma(sample))
+    finally:
+        pipeline.set_state(Gst.State.NULL)
+    return luma, encoded[0]
+
+
+def psnr(reference, test):
+    '''
+    Return peak signal-to-noise ratio (dB) of `test` frame compared to
+    `reference` frame (height x width arrays).
+    '''
+    error = reference.astype(np.float32) - test.astype(np.float32)
+    mse = (error * error).mean()
+    with np.errstate(divide='ignore'):
+        return 10 * np.log10(255. ** 2 / mse)
+
+
+def box_filter(frame, size):
+    '''
+    Return mean over `size`x`size` windows (valid region only) of frame,
+    using a summed area table.
+    '''
+    table = np.zeros((frame.shape[0] + 1, frame.shape[1] + 1))
+    table[1:, 1:] = frame.cumsum(axis=0).cumsum(axis=1)
+    return (table[size:, size:] - table[:-size, size:] -
+            table[size:, :-size] + table[:-size, :-size]) / size ** 2
+
+
+def ssim(reference, test, size=8):
+    '''
+    Return mean structural similarity (SSIM) of `test` frame compared to
+    `reference` frame (height x width arrays), over `size`x`size` windows.
+    '''
+    c1 = (.01 * 255) ** 2
+    c2 = (.03 * 255) ** 2
+    x = reference.astype(np.float64)
+    y = test.astype(np.float64)
+    mu_x = box_filter(x, size)
+    mu_y = box_filter(y, size)
+    var_x = box_filter(x * x, size) - mu_x * mu_x
+    var_y = box_filter(y * y, size) - mu_y * mu_y
+    covar = box_filter(x * y, size) - mu_x * mu_y
+    ssim_map = (((2 * mu_x * mu_y + c1) * (2 * covar + c2)) /
+                ((mu_x * mu_x + mu_y * mu_y + c1) * (var_x + var_y + c2)))
+    return ssim_map.mean()
+
+
+def calibrate(device_config, bitrates=BITRATES, target_ssim=.95,
+              target_psnr=None, duration=2., cache_path=None, store=True):
+    '''
+    Calibrate encode bit rate for the mode of `device_config`.
+
+    Arguments
+    ---------
+
+     - `bitrates`: Candidate bit rates (bits/second).
+     - `target_ssim`: Minimum mean SSIM of encoded sample.
+     - `target_psnr`: Minimum mean PSNR (dB) of encoded sample (optional).
+     - `duration`: Duration (in seconds) of sample.
+     - `store`: If `True`, store the lowest bit rate meeting the target
+       quality (or the highest candidate if none does) in the cache.
+
+    Returns `pandas.DataFrame` with one row per candidate bit rate, including
+    the encoded size and quality of the sample.
+    '''
+    samples = capture_sample(device_config, duration)
+    reference = [get_luma(s) for s in samples]
+    framerate = device_config['framerate']
+
+    rows = []
+    for bitrate in sorted(bitrates):
+        luma, encoded_bytes = encode_decode(samples, bitrate, framerate)
+        # Compare frame by frame, to bound memory use for long samples.
+        frames = list(zip(reference, luma))
+        rows.append({'bitrate': bitrate,
+                     'encoded_bitrate': 8 * encoded_bytes * framerate /
+                     len(samples),
+                     'psnr': np.mean([psnr(x, y) for x, y in frames]),
+                     'ssim': np.mean([ssim(x, y) for x, y in frames])})
+    df_results = pd.DataFrame(rows, columns=['bitrate', 'encoded_bitrate',
+                                             'psnr', 'ssim'])
+    df_results['meets_target'] = df_results.ssim >= (target_ssim or 0)
+    if target_psnr is not None:
+        df_results['meets_target'] &= df_results.psnr >= target_psnr
+
+    if store:
+        passing = df_results.bitrate[df_results.meets_target]
+        bitrate = (passing.min() if passing.size else
+                   df_results.bitrate.max())
+        store_bitrate(device_config, bitrate, cache_path)
+    return df_results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from .caps import get_device_configs
+
+    parser = argparse.ArgumentParser(description='Calibrate encode bit rate '
+                                     'of camera modes.')
+    parser.add_argument('--target-ssim', type=float, default=.95)
+    parser.add_argument('--target-psnr', type=float)
+    parser.add_argument('--duration', type=float, default=2.)
+    parser.add_argument('--device', help='Only calibrate modes of device.')
+    parser.add_argument('--cache', help='Cache file (default: %s).' %
+                        CACHE_PATH)
+    args = parser.parse_args()
+
+    Gst.init(None)
+    device_configs = get_device_configs()
+    if args.device:
+        device_configs = device_configs[device_configs.device ==
+                                        args.device]
+    for i, device_config in device_configs.iterrows():
+        df_results = calibrate(device_config, target_ssim=args.target_ssim,
+                               target_psnr=args.target_psnr,
+                               duration=args.duration, cache_path=args.cache)
+        print('%s %dx%d %.0ffps' % (device_config.device, device_config.width,
+                                    device_config.height,
+                                    device_config.framerate))
+        print(df_results.to_string(index=False))
+        print('')
@@ -10,6 +10,8 @@ import pandas as pd
 import numpy as np
 from path_helpers import path
 
+from .simulate import SIMULATED_DEVICES, is_simulated, make_simulated_source
+
 
 class DeviceNotFound(Exception):
     pass
@@ -46,11 +48,20 @@ def get_video_device_key():
 
 
 def get_video_sources():
+    '''
+    Return list of video devices, including any simulated devices (see
+    `simulate` module).
+    '''
+    simulated = list(SIMULATED_DEVICES)
     if platform.system() == 'Linux':
         try:
             devices = path('/dev/v4l/by-id').listdir()
         except OSError:
-            raise DeviceNotFound, 'No devices available'
+            if not simulated:
+                raise DeviceNotFound, 'No devices available'
+            devices = []
+    elif simulated:
+        devices = []
     else:
 #         try:
 #             devices = GstVideoSourceManager.get_video_source().probe_get_values_name(
@@ -61,7 +72,7 @@ def get_video_sources():
 #             raise DeviceNotFound, 'No devices available'
 #         device_key = 'device-name'
         raise ValueError('Unsupported platform: %s' % platform.system())
-    return devices
+    return devices + simulated
 
 
 def get_caps_str(device_config):
@@ -150,11 +161,19 @@ def process_dict(d):
     return d['key'], value
 
 
-def get_video_source():
+def get_video_source(device=None):
+    '''
+    Return video source element.  If `device` is provided, the source
+    captures from the device (either a real or simulated device).
+    '''
+    if device is not None and is_simulated(device):
+        return make_simulated_source(str(device), 'video_source')
     if platform.system() == 'Linux':
         video_source = Gst.ElementFactory.make('v4l2src', 'video_source')
     else:
         video_source = Gst.ElementFactory.make('dshowvideosrc', 'video_source')
+    if device is not None:
+        video_source.set_property(get_video_device_key(), device)
     return video_source
 
 
@@ -173,9 +192,7 @@ class VideoSourceCaps(object):
         if video_device is None:
             self.src = Gst.ElementFactory.make('autovideosrc', None)
         else:
-            self.src = get_video_source()
-            device_key = get_video_device_key()
-            self.src.set_property(device_key, video_device)
+            self.src = get_video_source(video_device)
 
         # Add elements to the pipeline
         self.pipeline.add(self.src)
@@ -213,6 +230,15 @@ def get_device_configs():
             df_device_i.insert(0, 'device', str(device))
             frames.append(df_device_i)
 
+    return merge_device_configs(frames)
+
+
+def merge_device_configs(frames):
+    '''
+    Combine per-device configuration frames (each including a `device`
+    column) into a single frame in the format returned by
+    `get_device_configs()`.
+    '''
     device_configs = pd.concat(frames).drop_duplicates()
     device_configs['label'] = device_configs.device.map(
         lambda x: x.split('/')[-1].split('-')[1].split('_')[0])
@@ -0,0 +1,68 @@
+'''
+Media information for recordings.
+'''
+from __future__ import division
+
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('GstPbutils', '1.0')
+from gi.repository import Gst, GstPbutils
+from path_helpers import path
+
+
+def get_discoverer(timeout=10.):
+    '''
+    Return `GstPbutils.Discoverer` with the specified timeout (in seconds).
+
+    __NB__ A discoverer must not be used from more than one thread at a time.
+    '''
+    return GstPbutils.Discoverer.new(int(timeout * Gst.SECOND))
+
+
+def discover(file_path, discoverer=None):
+    '''
+    Return dictionary of media information for the first video stream of a
+    recording:
+
+     - `duration`: Duration in seconds.
+     - `width`, `height`: Frame size in pixels.
+     - `framerate`: Frame rate in frames/second.
+     - `codec`: Codec description (e.g., `MPEG-4 Video`).
+     - `bitrate`: Video bit rate in bits/second (if known, otherwise the
+       average bit rate of the file).
+     - `container`: Container caps string.
+     - `caps`: Video caps string, including stream headers (e.g.,
+       `codec_data`).
+     - `seekable`: `True` if the file is seekable.
+    '''
+    if discoverer is None:
+        discoverer = get_discoverer()
+    file_path = path(file_path).abspath()
+    info = discoverer.discover_uri(Gst.filename_to_uri(str(file_path)))
+
+    container = info.get_stream_info()
+    duration = info.get_duration() / Gst.SECOND
+    result = {'duration': duration,
+              'container': (container.get_caps().to_string()
+                            if isinstance(container,
+                                          GstPbutils.DiscovererContainerInfo)
+                            else None),
+              'seekable': info.get_seekable()}
+
+    video_streams = info.get_video_streams()
+    if video_streams:
+        video = video_streams[0]
+        caps = video.get_caps()
+        bitrate = video.get_bitrate() or video.get_max_bitrate()
+        if not bitrate and duration > 0:
+            bitrate = 8 * file_path.getsize() / duration
+        result.update({'width': video.get_width(),
+                       'height': video.get_height(),
+                       'framerate': (video.get_framerate_num() /
+                                     video.get_framerate_denom()
+                                     if video.get_framerate_denom() else
+                                     None),
+                       'codec': GstPbutils.pb_utils_get_codec_description(caps),
+                       'bitrate': bitrate,
+                       'caps': caps.to_string()})
+    return result
@@ -0,0 +1,181 @@
+'''
+Record several cameras composited into a single grid frame (i.e., mosaic).
+
+Each camera source is scaled to the tile size and all tiles are composited on
+the timeline of the pipeline, so the mosaic is encoded once, to a single file.
+Encoding one mosaic of a given resolution costs about the same as encoding one
+camera at that resolution, rather than one encoder per camera.
+'''
+from __future__ import division
+import math
+import threading
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from .caps import get_video_source, get_caps_str, get_bitrate
+from .pipeline import make_muxer, make_preview_rate
+from .snapshot import PreviewRateMixin
+
+
+def get_layout(count, columns=None):
+    '''
+    Return `(columns, rows)` of grid for `count` tiles.  By default, the grid
+    is as close to square as possible.
+    '''
+    if columns is None:
+        columns = int(math.ceil(math.sqrt(count)))
+    return columns, int(math.ceil(count / columns))
+
+
+class MosaicPipeline(PreviewRateMixin):
+    def run(self, xid, output_path, device_configs, columns=None,
+            tile_width=640, tile_height=480, framerate=30, bitrate=None,
+            preview_sink=None, play=True):
+        '''
+        Draw mosaic of video sources to window with the specified `xid` and
+        record the mosaic to the specified output file path.
+
+        Arguments
+        ---------
+
+         - `xid`: Integer identifier of window to draw frames to.
+         - `output_path`: Output file path (`avi` or `mp4`).
+         - `device_configs`: List of configurations, each in the format of a
+           row of a frame returned by `caps.get_device_configs()`.  Tiles are
+           filled in order, row by row.
+         - `columns`: Number of grid columns (default: square grid).
+         - `tile_width`, `tile_height`: Size (in pixels) of each tile.
+         - `framerate`: Mosaic frame rate (in frames/second).  Sources are
+           converted to this frame rate.
+         - `bitrate`: Target encode bit rate in bits/second (default: based on
+           mosaic height, see `caps.get_bitrate()`).
+         - `preview_sink`: Sink element to send preview frames to, instead of
+           drawing frames to window `xid`.
+         - `play`: If `False`, build the pipeline without starting it (see
+           `play()`).
+        '''
+        self.xid = xid
+        self._eos = threading.Event()
+        self.columns, self.rows = get_layout(len(device_configs), columns)
+        width = self.columns * tile_width
+        height = self.rows * tile_height
+
+        self.pipeline = Gst.Pipeline()
+        self.bus = self.pipeline.get_bus()
+        self.bus.add_signal_watch()
+        self.bus.connect('message::error', self.on_error)
+        self.bus.enable_sync_message_emission()
+        self.bus.connect('sync-message::element', self.on_sync_message)
+
+        self.compositor = Gst.ElementFactory.make('compositor', None)
+        # Black background for empty tiles.
+        self.compositor.set_property('background', 1)
+        self.sources = [self.add_source(i, device_config, tile_width,
+                                        tile_height, framerate)
+                        for i, device_config in enumerate(device_configs)]
+
+        filter_ = Gst.ElementFactory.make('capsfilter', None)
+        filter_.set_property('caps',
+                             Gst.Caps('video/x-raw,width=%d,height=%d,'
+                                      'framerate=%d/1' % (width, height,
+                                                          framerate)))
+        tee = Gst.ElementFactory.make('tee', None)
+        if preview_sink is None:
+            self.sink = Gst.ElementFactory.make('autovideosink', 'sink')
+            self.sink.set_property('sync', False)
+        else:
+            self.sink = preview_sink
+        self.preview_rate = make_preview_rate()
+        capture_queue = Gst.ElementFactory.make('queue', None)
+        convert = Gst.ElementFactory.make('videoconvert', None)
+        encoder = Gst.ElementFactory.make('avenc_mpeg4', None)
+        encoder.set_property('bitrate', bitrate or get_bitrate(height))
+        encoder.set_property('bitrate-tolerance', 500 << 10)
+        muxer = make_muxer(output_path)
+        filesink = Gst.ElementFactory.make('filesink', None)
+        filesink.set_property('location', str(output_path))
+
+        mosaic_elements = (self.compositor, filter_, tee)
+        sink_elements = (Gst.ElementFactory.make('queue', None),
+                         self.preview_rate, self.sink)
+        capture_elements = (capture_queue, convert, encoder, muxer, filesink)
+        for elements in (mosaic_elements, sink_elements, capture_elements):
+            for e in elements:
+                self.pipeline.add(e)
+            for i, j in zip(elements[:-1], elements[1:]):
+                i.link(j)
+        tee.link(sink_elements[0])
+        tee.link(capture_elements[0])
+
+        self.output_path = output_path
+        self.capture_queue = capture_queue
+        self.encoder = encoder
+        self.muxer = muxer
+        if play:
+            self.play()
+
+    def add_source(self, index, device_config, tile_width, tile_height,
+                   framerate):
+        '''
+        Add source for `device_config`, scaled to tile size and linked to the
+        compositor at tile `index`.
+        '''
+        src = get_video_source(device_config['device'])
+        # Element names must be unique within the pipeline.
+        src.set_name('video_source%d' % index)
+        src_filter = Gst.ElementFactory.make('capsfilter', None)
+        src_filter.set_property('caps', Gst.Caps(get_caps_str(device_config)))
+        videorate = Gst.ElementFactory.make('videorate', None)
+        videoscale = Gst.ElementFactory.make('videoscale', None)
+        convert = Gst.ElementFactory.make('videoconvert', None)
+        tile_filter = Gst.ElementFactory.make('capsfilter', None)
+        tile_filter.set_property('caps',
+                                 Gst.Caps('video/x-raw,width=%d,height=%d,'
+                                          'framerate=%d/1,'
+                                          'pixel-aspect-ratio=1/1' %
+                                          (tile_width, tile_height,
+                                           framerate)))
+        # Decouple each source from the compositor.
+        queue = Gst.ElementFactory.make('queue', None)
+        elements = (src, src_filter, videorate, videoscale, convert,
+                    tile_filter, queue)
+        for e in elements:
+            self.pipeline.add(e)
+        for i, j in zip(elements[:-1], elements[1:]):
+            i.link(j)
+
+        pad = self.compositor.get_request_pad('sink_%u')
+        pad.set_property('xpos', (index % self.columns) * tile_width)
+        pad.set_property('ypos', (index // self.columns) * tile_height)
+        queue.get_static_pad('src').link(pad)
+        return elements
+
+    def play(self):
+        self._eos.clear()
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def on_sync_message(self, bus, msg):
+        if msg.get_structure().get_name() == 'prepare-window-handle':
+            msg.src.set_property('force-aspect-ratio', True)
+            msg.src.set_window_handle(self.xid)
+
+    def on_error(self, bus, msg):
+        print('on_error():', msg.parse_error())
+
+    def eos_callback(self, pad, info):
+        if info.get_event().type != Gst.EventType.EOS:
+            return Gst.PadProbeReturn.OK
+        self._eos.set()
+        return Gst.PadProbeReturn.REMOVE
+
+    def stop(self, timeout=2.):
+        # Sending EOS to the pipeline sends EOS from every source.  The
+        # compositor forwards EOS once all sources are finished, so the
+        # muxer finalizes the file (e.g., writes the `mp4` header).
+        self.muxer.get_static_pad('src')\
+            .add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, self.eos_callback)
+        self.pipeline.send_event(Gst.Event.new_eos())
+        self._eos.wait(timeout)
+        self.pipeline.set_state(Gst.State.NULL)
@@ -0,0 +1,288 @@
+'''
+Priority-based load shedding across cameras.
+
+An `OverloadManager` monitors the cameras of a host (each controlled by a
+`PipelineManager`) for *sustained* overload, i.e., any of:
+
+ - capture queue (or buffered writer, see `writer` module) backlog above
+   `queue_threshold` (fraction of capacity),
+ - frames dropped by the source `videorate` at a rate above
+   `drop_threshold` (fraction of the nominal frame rate), or
+ - host CPU usage above `cpu_threshold`,
+
+for `sustain` consecutive checks.  Load is then shed one step at a time:
+
+ 1. Lower the preview frame rate, lowest priority cameras first.
+ 2. Switch low priority cameras (priority below `protect_priority`) to the
+    next cheaper capture mode (i.e., another row of `get_device_configs()`
+    for the same device and format), lowest priority first.
+
+Once load has subsided for `recover` consecutive checks, the most recent step
+is undone.  Cameras with priority at or above `protect_priority` always keep
+recording at their selected mode.
+'''
+from __future__ import division
+import threading
+import time
+
+import pandas as pd
+
+from .pipeline import next_segment_path
+
+
+def get_cpu_times():
+    '''
+    Return `(busy, total)` CPU time (in clock ticks) of the host.
+    '''
+    with open('/proc/stat') as stat:
+        fields = [int(v) for v in stat.readline().split()[1:]]
+    # Idle and I/O wait.
+    idle = sum(fields[3:5])
+    total = sum(fields)
+    return total - idle, total
+
+
+def get_config_cost(config):
+    return config['width'] * config['height'] * config['framerate']
+
+
+class OverloadManager(object):
+    '''
+    Arguments
+    ---------
+
+     - `check_interval`: Time (in seconds) between checks.
+     - `sustain`: Number of consecutive overloaded checks before shedding
+       a step.
+     - `recover`: Number of consecutive normal checks before restoring a
+       step.
+     - `queue_threshold`: Capture queue fill level (fraction) considered a
+       backlog.
+     - `drop_threshold`: Rate of frames dropped by the source `videorate`
+       (fraction of the nominal frame rate of the camera) considered
+       overloaded.
+     - `cpu_threshold`: Host CPU usage (fraction) considered overloaded.
+     - `preview_framerate`: Preview frame rate when shedding preview load.
+     - `protect_priority`: Cameras with at least this priority never have
+       their capture mode lowered.
+    '''
+    def __init__(self, check_interval=1., sustain=3, recover=10,
+                 queue_threshold=.5, drop_threshold=.05, cpu_threshold=.9,
+                 preview_framerate=5, protect_priority=1):
+        self.check_interval = check_interval
+        self.sustain = sustain
+        self.recover = recover
+        self.queue_threshold = queue_threshold
+        self.drop_threshold = drop_threshold
+        self.cpu_threshold = cpu_threshold
+        self.preview_framerate = preview_framerate
+        self.protect_priority = protect_priority
+        self.cameras = {}
+        self.steps = []
+        self.history = []
+        self._overloaded_count = 0
+        self._normal_count = 0
+        self._drops = {}
+        self._cpu_times = None
+        self._thread = None
+        self._running = threading.Event()
+
+    def add(self, name, manager, configs, priority=0):
+        '''
+        Arguments
+        ---------
+
+         - `name`: Camera name.
+         - `manager`: `PipelineManager` of the camera.
+         - `configs`: Frame in the format returned by `get_device_configs()`
+           containing candidate configurations for the camera device.
+         - `priority`: Camera priority (higher is more important).
+        '''
+        self.cameras[name] = {'manager': manager, 'configs': configs,
+                              'priority': priority, 'preview_framerate':
+                              None}
+
+    def start(self):
+        self._running.set()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running.clear()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while self._running.is_set():
+            self.check()
+            time.sleep(self.check_interval)
+
+    def measure(self):
+        '''
+        Return dictionary of load indicators: maximum capture queue (or
+        buffered writer) fill level, frames dropped since the previous
+        measurement, maximum drop rate (fraction of nominal frame rate) and
+        host CPU usage.
+        '''
+        queue_level = 0.
+        drops = 0
+        drop_rate = 0.
+        for name, camera in self.cameras.items():
+            pipeline = camera['manager'].pipeline
+            if pipeline is None or not hasattr(pipeline, 'pipeline'):
+                continue
+            queue = getattr(pipeline, 'capture_queue', None)
+            if queue is not None:
+                queue_level = max(queue_level,
+                                  float(queue.get_property('current-level-'
+                                                           'buffers')) /
+                                  queue.get_property('max-size-buffers'))
+            filesink = getattr(pipeline, 'filesink', None)
+            if hasattr(filesink, 'fill'):
+                # Backlog of buffered writer, i.e., disk not keeping up.
+                queue_level = max(queue_level, filesink.fill)
+            src_elements = getattr(pipeline, 'src_elements', ())
+            videorates = [e for e in src_elements
+                          if e.get_factory().get_name() == 'videorate']
+            if videorates:
+                dropped = videorates[0].get_property('drop')
+                now = time.time()
+                previous = self._drops.get(name, (None, 0, now))
+                if previous[0] is pipeline:
+                    delta = max(0, dropped - previous[1])
+                    drops += delta
+                    config = camera['manager'].active_config
+                    if now > previous[2] and config is not None and \
+                            config['framerate']:
+                        drop_rate = max(drop_rate, delta / (now - previous[2])
+                                        / config['framerate'])
+                self._drops[name] = (pipeline, dropped, now)
+
+        cpu = None
+        try:
+            busy, total = get_cpu_times()
+        except IOError:
+            pass
+        else:
+            if self._cpu_times is not None and total > self._cpu_times[1]:
+                cpu = (float(busy - self._cpu_times[0]) /
+                       (total - self._cpu_times[1]))
+            self._cpu_times = busy, total
+        return {'queue_level': queue_level, 'drops': drops,
+                'drop_rate': drop_rate, 'cpu': cpu}
+
+    def is_overloaded(self, measurement):
+        return (measurement['queue_level'] > self.queue_threshold or
+                measurement['drop_rate'] > self.drop_threshold or
+                (measurement['cpu'] is not None and
+                 measurement['cpu'] > self.cpu_threshold))
+
+    def check(self):
+        measurement = self.measure()
+        if self.is_overloaded(measurement):
+            self._overloaded_count += 1
+            self._normal_count = 0
+            if self._overloaded_count >= self.sustain:
+                self.shed()
+                self._overloaded_count = 0
+        else:
+            self._normal_count += 1
+            self._overloaded_count = 0
+            if self._normal_count >= self.recover and self.steps:
+                self.restore()
+                self._normal_count = 0
+        self.apply_preview()
+        return measurement
+
+    def next_step(self):
+        '''
+        Return next load shedding step as `(action, camera name, value)`, or
+        `None` if no more load can be shed.
+        '''
+        by_priority = sorted(self.cameras,
+                             key=lambda n: self.cameras[n]['priority'])
+        for name in by_priority:
+            if self.cameras[name]['preview_framerate'] is None:
+                return 'preview', name, self.preview_framerate
+        for name in by_priority:
+            camera = self.cameras[name]
+            if camera['priority'] >= self.protect_priority:
+                continue
+            config = self.get_cheaper_config(name)
+            if config is not None:
+                return 'config', name, config
+        return None
+
+    def get_cheaper_config(self, name):
+        '''
+        Return the most expensive configuration for the camera device that
+        is cheaper than the active configuration, or `None`.
+        '''
+        camera = self.cameras[name]
+        active = camera['manager'].active_config
+        if active is None:
+            return None
+        configs = camera['configs']
+        configs = configs[(configs.device == active['device']) &
+                          (configs.format == active['format'])]
+        costs = configs.apply(get_config_cost, axis=1)
+        cheaper = costs[costs < get_config_cost(active)]
+        if not cheaper.size:
+            return None
+        return configs.loc[cheaper.idxmax()]
+
+    def shed(self):
+        step = self.next_step()
+        if step is None:
+            return
+        action, name, value = step
+        camera = self.cameras[name]
+        if action == 'preview':
+            self.steps.append((action, name, camera['preview_framerate']))
+            camera['preview_framerate'] = value
+        else:
+            self.steps.append((action, name,
+                               camera['manager'].active_config))
+            self.switch_config(name, value)
+        self._log('shed', action, name, value)
+
+    def restore(self):
+        action, name, value = self.steps.pop()
+        if action == 'preview':
+            self.cameras[name]['preview_framerate'] = value
+        else:
+            self.switch_config(name, value)
+        self._log('restore', action, name, value)
+
+    def switch_config(self, name, config):
+        '''
+        Switch camera to `config`, continuing any recording in a new segment.
+        '''
+        manager = self.cameras[name]['manager']
+        record_path = manager.record_path
+        if record_path is not None:
+            record_path = str(next_segment_path(record_path))
+        manager.set_config(manager.xid, config, record_path=record_path,
+                           **manager.record_kwargs)
+
+    def apply_preview(self):
+        for camera in self.cameras.values():
+            pipeline = camera['manager'].pipeline
+            if hasattr(pipeline, 'set_preview_framerate'):
+                pipeline.set_preview_framerate(camera['preview_framerate'])
+
+    def _log(self, event, action, name, value):
+        if action == 'config':
+            value = '{width}x{height} {framerate:.0f}fps'.format(**value)
+        self.history.append({'time': time.time(), 'event': event,
+                             'action': action, 'camera': name,
+                             'value': value})
+
+    def history_frame(self):
+        '''
+        Return `pandas.DataFrame` with one row per shed or restored step.
+        '''
+        return pd.DataFrame(self.history, columns=['time', 'event', 'action',
+                                                   'camera', 'value'])
@@ -1,3 +1,6 @@
+from fractions import Fraction
+import re
+import threading
 import time
 from threading import Thread
 
@@ -5,15 +8,54 @@ import gi
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst, GstVideo
 from path_helpers import path
-from .caps import (get_video_source, get_caps_str, get_video_device_key,
-                   get_bitrate)
+from .calibrate import get_calibrated_bitrate
+from .caps import get_video_source, get_caps_str, get_bitrate
+from .registration import make_roi_elements
+from .snapshot import PreviewRateMixin, SnapshotMixin, SnapshotTap
 
 
-class DrawPipeline(object):
+def make_muxer(output_path):
+    '''
+    Return muxer element for the container corresponding to the extension of
+    the output file path (i.e., `avi` or `mp4`).
+    '''
+    if path(output_path).ext.lower() == '.mp4':
+        return Gst.ElementFactory.make('mp4mux', None)
+    elif path(output_path).ext.lower() == '.avi':
+        return Gst.ElementFactory.make('avimux', None)
+    else:
+        raise ValueError('Unsupported output file type: %s' %
+                         path(output_path).ext)
+
+
+def make_preview_rate():
+    '''
+    Return `videorate` element to limit the preview frame rate, e.g., to shed
+    load (see `set_preview_framerate()`).  By default, all frames pass.
+    '''
+    preview_rate = Gst.ElementFactory.make('videorate', None)
+    preview_rate.set_property('drop-only', True)
+    return preview_rate
+
+
+class DrawPipeline(SnapshotMixin, PreviewRateMixin):
     '''
     Draw video source to window with the specified `xid`.
     '''
-    def run(self, xid, device_config=None):
+    def run(self, xid, device_config=None, preview_sink=None, play=True):
+        '''
+        Arguments
+        ---------
+
+         - `xid`: Integer identifier of window to draw frames to.
+         - `device_config`: Configuration in the format of a row of a frame
+           returned by `caps.get_device_configs()`.
+         - `preview_sink`: Sink element to send frames to, instead of drawing
+           frames to window `xid` (e.g., `shmsink` to share frames with
+           another process).
+         - `play`: If `False`, build the pipeline without starting it (see
+           `play()`).
+        '''
         self.xid = xid
         # Create GStreamer pipeline
         self.pipeline = Gst.Pipeline()
@@ -31,22 +73,42 @@ class DrawPipeline(object):
         if device_config is None:
             self.src = Gst.ElementFactory.make('autovideosrc', 'source')
         else:
-            self.src = get_video_source()
-            device_key = get_video_device_key()
-            self.src.set_property(device_key, device_config['device'])
+            self.src = get_video_source(device_config['device'])
         self.filter_ = Gst.ElementFactory.make('capsfilter', 'filter')
-        self.sink = Gst.ElementFactory.make('autovideosink', 'sink')
-        self.sink.set_property('sync', False)
+        tee = Gst.ElementFactory.make('tee', None)
+        sink_queue = Gst.ElementFactory.make('queue', None)
+        if preview_sink is None:
+            self.sink = Gst.ElementFactory.make('autovideosink', 'sink')
+            self.sink.set_property('sync', False)
+        else:
+            self.sink = preview_sink
         caps = Gst.Caps(get_caps_str(device_config))
         self.filter_.set_property('caps', caps)
 
+        self.preview_rate = make_preview_rate()
+        self.snapshot_tap = SnapshotTap()
+
+        src_elements = (self.src, self.filter_, tee)
+        sink_elements = (sink_queue, self.preview_rate, self.sink)
+        snapshot_elements = self.snapshot_tap.make_elements()
+
         # Add elements to the pipeline
-        self.pipeline.add(self.src)
-        self.pipeline.add(self.filter_)
-        self.pipeline.add(self.sink)
+        for d in src_elements + sink_elements + snapshot_elements:
+            self.pipeline.add(d)
 
-        self.src.link(self.filter_)
-        self.filter_.link(self.sink)
+        for elements in (src_elements, sink_elements, snapshot_elements):
+            for i, j in zip(elements[:-1], elements[1:]):
+                i.link(j)
+
+        tee.link(sink_elements[0])
+        tee.link(snapshot_elements[0])
+
+        self.tee = tee
+        self.device_config = device_config
+        if play:
+            self.play()
+
+    def play(self):
         self.pipeline.set_state(Gst.State.PLAYING)
 
     def on_sync_message(self, bus, msg):
@@ -59,8 +121,13 @@ class DrawPipeline(object):
         print('on_error():', msg.parse_error())
 
 
-class RecordPipeline(object):
-    def run(self, xid, output_path, device_config=None, bitrate=350 << 3 << 10):
+class RecordPipeline(SnapshotMixin, PreviewRateMixin):
+    def run(self, xid, output_path, device_config=None, bitrate=None,
+            clock=None, base_time=None, play=True, streams=None,
+            timelapse_interval=None, timelapse_framerate=30,
+            preview_sink=None, crash_safe=True, fragment_duration=1000,
+            registration_path=None, write_buffer_size=None,
+            write_block_size=1 << 20, fsync='close', fsync_interval=1.):
         '''
         Draw video source to window with the specified `xid` and record the
         video to the specified output file path.
@@ -78,9 +145,57 @@ class RecordPipeline(object):
            * Configuration dictionary or a `pandas.Series` in the format of a
              row of a frame returned by `caps.get_device_configs()`.
            * If not provided, the GStreamer `autovideosrc` is used.
-         - `bitrate`: Target encode bit rate in bits/second (default=350kB/s)
+         - `bitrate`: Target encode bit rate in bits/second.  If not provided,
+           the calibrated bit rate of the device mode is used (see
+           `calibrate` module), or 350kB/s if the mode is not calibrated.
+         - `clock`: `Gst.Clock` to use for the pipeline (e.g., a clock shared
+           between several pipelines).  If not provided, the pipeline selects
+           a clock as usual.
+         - `base_time`: Base time (in clock time nanoseconds) to assign to the
+           pipeline.  If provided, the pipeline does *not* select its own base
+           time when set to `PLAYING`, which allows several pipelines to share
+           the same running time.
+         - `play`: If `False`, build the pipeline without starting it (see
+           `play()`).
+         - `streams`: List of stream outputs (see `stream` module), each fed
+           from the encoder output.  Streams may also be added or removed
+           while recording using `add_stream()` and `remove_stream()`.
+         - `timelapse_interval`: If provided, record in time-lapse mode, i.e.,
+           record one frame every `timelapse_interval` seconds.  Frames are
+           dropped at the start of the capture branch, so dropped frames are
+           never queued or encoded.  The preview is not affected.
+         - `timelapse_framerate`: Playback frame rate (in frames/second) of
+           time-lapse recording (default=30).
+         - `preview_sink`: Sink element to send preview frames to, instead of
+           drawing frames to window `xid` (e.g., `shmsink` to share frames
+           with another process).
+         - `crash_safe`: If `True` (default) and recording to `mp4`, write
+           the file as self-contained fragments, each with its own index.  If
+           recording is interrupted without EOS (e.g., the process is killed
+           or power is lost), the file remains playable up to the last
+           complete fragment after running `recover.recover()`.  If `False`,
+           an interrupted `mp4` recording can not be recovered.  Interrupted
+           `avi` recordings may always be recovered.
+         - `fragment_duration`: Duration (in milliseconds) of each fragment of
+           a crash safe recording (default=1000).
+         - `registration_path`: If provided, path to registration points file
+           (see `registration` module).  Only the perspective-corrected region
+           of interest defined by the points is recorded.  The preview is not
+           affected.
+         - `write_buffer_size`: If provided, write the output file from a
+           dedicated writer thread through an in-memory buffer of this size
+           (in bytes), rather than from the streaming thread (see `writer`
+           module).  Buffer fill level is available as `filesink.fill` and
+           write statistics from `filesink.stats()`.
+         - `write_block_size`: Size (in bytes) of aligned writes of buffered
+           output (default=1MB).
+         - `fsync`: File sync policy of buffered output (`'never'`, `'close'`
+           or `'interval'`, default=`'close'`).
+         - `fsync_interval`: Time (in seconds) between syncs for `'interval'`
+           policy (default=1).
         '''
         self.xid = xid
+        self._eos = threading.Event()
         # Create GStreamer pipeline
         self.pipeline = Gst.Pipeline()
 
@@ -97,29 +212,39 @@ class RecordPipeline(object):
         if device_config is None:
             self.src = Gst.ElementFactory.make('autovideosrc', 'source')
         else:
-            self.src = get_video_source()
-            device_key = get_video_device_key()
-            self.src.set_property(device_key, device_config['device'])
-        self.sink = Gst.ElementFactory.make('autovideosink', 'sink')
-        self.sink.set_property('sync', False)
+            self.src = get_video_source(device_config['device'])
+        if preview_sink is None:
+            self.sink = Gst.ElementFactory.make('autovideosink', 'sink')
+            self.sink.set_property('sync', False)
+        else:
+            self.sink = preview_sink
 
         self.filter_ = Gst.ElementFactory.make('capsfilter', 'filter')
         tee = Gst.ElementFactory.make('tee', None)
 
         sink_queue = Gst.ElementFactory.make('queue', None)
         capture_queue = Gst.ElementFactory.make('queue', None)
+        if bitrate is None:
+            bitrate = get_calibrated_bitrate(device_config) or 350 << 3 << 10
         encoder = Gst.ElementFactory.make('avenc_mpeg4', None)
         encoder.set_property('bitrate', bitrate)
         encoder.set_property('bitrate-tolerance', 500 << 10)
-        if path(output_path).ext.lower() == '.mp4':
-            muxer = Gst.ElementFactory.make('mp4mux', None)
-        elif path(output_path).ext.lower() == '.avi':
-            muxer = Gst.ElementFactory.make('avimux', None)
+        # Share encoded frames between the output file and any streams.
+        encoder_tee = Gst.ElementFactory.make('tee', None)
+        muxer = make_muxer(output_path)
+        if crash_safe and path(output_path).ext.lower() == '.mp4':
+            muxer.set_property('fragment-duration', fragment_duration)
+        if write_buffer_size is None:
+            filesink = Gst.ElementFactory.make('filesink', None)
+            filesink.set_property('location', output_path)
         else:
-            raise ValueError('Unsupported output file type: %s' %
-                             path(output_path).ext)
-        filesink = Gst.ElementFactory.make('filesink', None)
-        filesink.set_property('location', output_path)
+            from .writer import BufferedFileSink
+
+            filesink = BufferedFileSink(output_path,
+                                        buffer_size=write_buffer_size,
+                                        block_size=write_block_size,
+                                        fsync=fsync,
+                                        fsync_interval=fsync_interval)
 
         videorate = Gst.ElementFactory.make('videorate', None)
         filter1 = Gst.ElementFactory.make('capsfilter', None)
@@ -131,31 +256,125 @@ class RecordPipeline(object):
         self.filter_.set_property('caps', caps)
 
         src_elements = (self.src, self.filter_, videorate, filter1, tee)
-        sink_elements = (sink_queue, self.sink)
-        capture_elements = (capture_queue, encoder, muxer, filesink)
+        self.preview_rate = make_preview_rate()
+        sink_elements = (sink_queue, self.preview_rate, self.sink)
+        capture_elements = (capture_queue, encoder, encoder_tee, muxer,
+                            filesink)
+        if registration_path is not None:
+            # Rectify and crop frames in the capture thread, before encoding.
+            capture_elements = ((capture_queue, ) +
+                                make_roi_elements(registration_path,
+                                                  device_config['width'],
+                                                  device_config['height']) +
+                                capture_elements[1:])
+        self.snapshot_tap = SnapshotTap()
+        snapshot_elements = self.snapshot_tap.make_elements()
+        if timelapse_interval is not None:
+            capture_elements = (self.make_timelapse_elements(timelapse_interval,
+                                                             timelapse_framerate)
+                                + capture_elements)
 
         # Add elements to the pipeline
-        for d in src_elements + sink_elements + capture_elements:
+        for d in (src_elements + sink_elements + capture_elements +
+                  snapshot_elements):
             self.pipeline.add(d)
 
-        for elements in (src_elements, sink_elements, capture_elements):
+        for elements in (src_elements, sink_elements, capture_elements,
+                         snapshot_elements):
             for i, j in zip(elements[:-1], elements[1:]):
                 i.link(j)
 
         tee.link(sink_elements[0])
         tee.link(capture_elements[0])
-
+        tee.link(snapshot_elements[0])
 
         self.output_path = output_path
         self.tee = tee
+        # Tee source pad feeding the capture branch.
+        self.capture_pad = capture_elements[0].get_static_pad('sink').get_peer()
+        self.capture_queue = capture_queue
+        self.encoder = encoder
+        self.encoder_tee = encoder_tee
         self.muxer = muxer
+        self.filesink = filesink
         self.src_elements = src_elements
         self.sink_elements = sink_elements
         self.capture_elements = capture_elements
+        self.streams = []
 
+        for stream in (streams or []):
+            self.add_stream(stream)
+
+        if clock is not None:
+            self.pipeline.use_clock(clock)
+        if base_time is not None:
+            # Disable automatic base time selection so that the base time
+            # remains fixed across state changes.
+            self.pipeline.set_start_time(Gst.CLOCK_TIME_NONE)
+            self.pipeline.set_base_time(base_time)
+
+        if play:
+            self.play()
+
+    def play(self):
+        self._eos.clear()
         self.pipeline.set_state(Gst.State.PLAYING)
         self._alive = True
 
+    @staticmethod
+    def make_timelapse_elements(interval, framerate):
+        '''
+        Return elements that keep one frame per `interval` seconds and
+        time stamp the kept frames for playback at `framerate` frames/second.
+        '''
+        # Speed up time stamps such that `interval` seconds of capture map to
+        # a single frame at the playback frame rate.  With `drop-only`,
+        # `videorate` then drops all frames but one per playback frame
+        # period (i.e., it never duplicates frames).
+        timelapse_rate = Gst.ElementFactory.make('videorate', None)
+        timelapse_rate.set_property('drop-only', True)
+        timelapse_rate.set_property('rate', float(interval) * framerate)
+        framerate = Fraction(framerate).limit_denominator(1001)
+        timelapse_filter = Gst.ElementFactory.make('capsfilter', None)
+        timelapse_filter.set_property('caps',
+                                      Gst.Caps('video/x-raw,framerate=%d/%d'
+                                               % (framerate.numerator,
+                                                  framerate.denominator)))
+        return timelapse_rate, timelapse_filter
+
+    def add_stream(self, stream):
+        '''
+        Attach stream output (see `stream` module) to the encoder output.
+
+        May be called before or while the pipeline is playing.
+        '''
+        elements = stream.make_elements()
+        for e in elements:
+            self.pipeline.add(e)
+        for i, j in zip(elements[:-1], elements[1:]):
+            i.link(j)
+        for e in elements[::-1]:
+            e.sync_state_with_parent()
+        stream.tee_pad = self.encoder_tee.get_request_pad('src_%u')
+        stream.tee_pad.link(elements[0].get_static_pad('sink'))
+        self.streams.append(stream)
+
+    def remove_stream(self, stream):
+        '''
+        Detach stream output from the encoder output, without interrupting
+        the recording.
+        '''
+        def _remove(pad, info):
+            pad.unlink(stream.elements[0].get_static_pad('sink'))
+            self.encoder_tee.release_request_pad(pad)
+            for e in stream.elements:
+                e.set_state(Gst.State.NULL)
+                self.pipeline.remove(e)
+            return Gst.PadProbeReturn.REMOVE
+
+        self.streams.remove(stream)
+        stream.tee_pad.add_probe(Gst.PadProbeType.IDLE, _remove)
+
     def on_sync_message(self, bus, msg):
         if msg.get_structure().get_name() == 'prepare-window-handle':
             print('prepare-window-handle')
@@ -165,21 +384,45 @@ class RecordPipeline(object):
     def on_error(self, bus, msg):
         print('on_error():', msg.parse_error())
 
-    def eos_callback(self, pad, event):
-        self.muxer.get_static_pad('src').remove_probe(self.eos_probe)
+    def eos_callback(self, pad, info):
+        # Muxer may push other events (e.g., a new segment to rewrite the
+        # file header) before EOS.
+        if info.get_event().type != Gst.EventType.EOS:
+            return Gst.PadProbeReturn.OK
         self._alive = False
-        return True
+        self._eos.set()
+        return Gst.PadProbeReturn.REMOVE
 
-    def block_callback(self, pad, event):
+    def send_capture_eos(self):
+        '''
+        Send EOS event through the capture branch and notify `eos_callback`
+        when the EOS reaches the muxer output.
+        '''
         mux_pad = self.muxer.get_static_pad('src')
         capture_pad = self.capture_elements[0].get_static_pad('sink')
-        self.eos_probe = mux_pad.add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM,
-                                           self.eos_callback)
+        mux_pad.add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, self.eos_callback)
         capture_pad.send_event(Gst.Event.new_eos())
-        self.tee.pads[2].remove_probe(self.block_probe)
+
+    def block_callback(self, pad, event):
+        self.send_capture_eos()
+        self.capture_pad.remove_probe(self.block_probe)
         return True
 
-    def stop(self):
+    def abort(self, timeout=.5):
+        '''
+        Finalize the output file and stop the pipeline *without* waiting for
+        the capture branch to drain from the source (e.g., after the source
+        stalled or failed).
+
+        Frames queued in the capture branch are still written, but the EOS is
+        only awaited for up to `timeout` seconds.
+        '''
+        self.send_capture_eos()
+        self._eos.wait(timeout)
+        self.pipeline.set_state(Gst.State.NULL)
+        self._alive = False
+
+    def stop(self, timeout=2.):
         # Start callback chain to send EOS (end of stream) event to video
         # muxer.  This is required, for example, when recording to `mp4`, where
         # the EOS event triggers the muxer to write the video header to the
@@ -190,49 +433,165 @@ class RecordPipeline(object):
         #  - Block the tee source pad for the capture branch
         #  - Send EOS event through the capture queue `sink` pad
         #  - Wait until EOS is received by the muxer `sink` pad
-        #  - Stop the pipeline (wait is complete when `self._alive` is `True`)
+        #  - Stop the pipeline (wait is complete when `self._eos` is set, or
+        #    after `timeout` seconds)
         #
         # [1]: http://gstreamer.freedesktop.org/data/doc/gstreamer/head/manual/html/section-dynamic-pipelines.html#section-dynamic-changing
-        self.block_probe = self.tee.pads[2].add_probe(Gst.PadProbeType.BLOCK_DOWNSTREAM,
+        self.block_probe = self.capture_pad.add_probe(Gst.PadProbeType.BLOCK_DOWNSTREAM,
                                                       self.block_callback)
-        for i in range(10):
-            if not self._alive:
-                self.pipeline.set_state(Gst.State.NULL)
-                break
-            time.sleep(.2)
+        self._eos.wait(timeout)
+        self.pipeline.set_state(Gst.State.NULL)
+
+
+def next_segment_path(output_path):
+    '''
+    Return path for the next segment of a recording, e.g., `name_seg1.mp4`
+    for `name.mp4` and `name_seg2.mp4` for `name_seg1.mp4`.
+    '''
+    output_path = path(output_path)
+    match = re.search(r'^(?P<name>.*)_seg(?P<count>\d+)$', output_path.namebase)
+    if match:
+        name = match.group('name')
+        count = int(match.group('count')) + 1
+    else:
+        name = output_path.namebase
+        count = 1
+    return output_path.parent.joinpath('%s_seg%d%s' % (name, count,
+                                                       output_path.ext))
 
 
 class PipelineManager(object):
-    def __init__(self):
+    '''
+    Arguments
+    ---------
+
+     - `pool`: Optional `pool.PipelinePool`.  If provided, preview pipelines
+       are taken from (and returned to) the pool where possible, neighbouring
+       configurations are pre-built after each switch and the latency of each
+       switch is recorded in the pool.
+
+    If set, `on_created(pipeline)` is called with each new pipeline (built or
+    taken from the pool) *before* it is started, e.g., to connect bus
+    handlers that must not miss any message.
+    '''
+    def __init__(self, pool=None):
+        self.pool = pool
+        self.on_created = None
         self.pipeline = None
         self.active_config = None
+        self.xid = None
+        self.record_path = None
+        self.record_kwargs = {}
+        self._lock = threading.RLock()
+
+    def set_config(self, xid, device_config, record_path=None,
+                   **record_kwargs):
+        '''
+        Stop the active pipeline (if any) and start a new pipeline for the
+        specified device configuration.
 
-    def set_config(self, xid, device_config, record_path=None):
+        If `record_path` is provided, video is recorded to the specified path
+        and any additional keyword arguments (e.g., `timelapse_interval`) are
+        passed to `RecordPipeline.run()`.
+        '''
         print get_caps_str(device_config)
 
-        self._stop()
+        with self._lock:
+            start = time.time()
+            self._stop()
+            hit = self._start(xid, device_config, record_path, record_kwargs)
+            if self.pool is not None:
+                self.pipeline.pipeline.get_state(5 * Gst.SECOND)
+                self.pool.record_switch(device_config, hit,
+                                        time.time() - start)
+                if record_path is None:
+                    self.pool.prefetch(xid, device_config)
+
+    def restart(self, record_path=None):
+        '''
+        Tear down the active pipeline (without waiting for the source to
+        drain) and start a new pipeline with the same configuration.
+
+        If the active pipeline is recording, the new pipeline records to
+        `record_path` (default: next segment path, see `next_segment_path()`).
+        '''
+        with self._lock:
+            if self.pipeline is None:
+                return
+            if hasattr(self.pipeline, 'abort'):
+                self.pipeline.abort()
+            else:
+                self.pipeline.pipeline.set_state(Gst.State.NULL)
+            if self.record_path is not None and record_path is None:
+                record_path = str(next_segment_path(self.record_path))
+            self._start(self.xid, self.active_config, record_path,
+                        self.record_kwargs)
+
+    def _start(self, xid, device_config, record_path, record_kwargs):
         self.active_config = device_config  # = configs.iloc[config_index]
+        self.xid = xid
+        self.record_path = record_path
+        self.record_kwargs = record_kwargs
+        if self.pool is not None:
+            # Release pooled pipelines before opening the device to record.
+            self.pool.set_active(xid, device_config,
+                                 recording=record_path is not None)
 
         kwargs = {'device_config': device_config}
         if record_path is not None:
             self.pipeline = RecordPipeline()
             kwargs['output_path'] = record_path
-            kwargs['bitrate'] = get_bitrate(device_config.height)
+            kwargs['bitrate'] = (get_calibrated_bitrate(device_config) or
+                                 get_bitrate(device_config.height))
+            kwargs.update(record_kwargs)
         else:
+            if self.pool is not None:
+                pipeline = self.pool.get(xid, device_config)
+                if pipeline is not None:
+                    # Pre-built pipeline is already in `READY` state.
+                    self.pipeline = pipeline
+                    if self.on_created is not None:
+                        self.on_created(self.pipeline)
+                    self.pipeline.play()
+                    return True
             self.pipeline = DrawPipeline()
 
+        # Start pipeline once built, after calling `on_created()`.
+        play = kwargs.pop('play', True)
+        kwargs['play'] = False
         gst_thread = Thread(target=self.pipeline.run, args=(xid, ), kwargs=kwargs)
         gst_thread.daemon = True
         gst_thread.start()
         gst_thread.join()
+        if self.on_created is not None:
+            self.on_created(self.pipeline)
+        if play:
+            self.pipeline.play()
+        return False
+
+    def stop(self):
+        '''
+        Stop the active pipeline (if any), waiting for any recording to be
+        finalized.
+        '''
+        with self._lock:
+            self._stop()
+            self.pipeline = None
+            self.record_path = None
+            if self.pool is not None:
+                self.pool.set_active(None, None)
 
     def _stop(self):
         if self.pipeline is not None and hasattr(self.pipeline, 'pipeline'):
             if hasattr(self.pipeline, 'stop'):
                 self.pipeline.stop()
+            elif self.pool is not None:
+                # Keep preview pipeline warm, e.g., to switch back quickly.
+                self.pool.put(self.xid, self.pipeline)
             else:
                 self.pipeline.pipeline.set_state(Gst.State.NULL)
-            time.sleep(0.05)
+            # Wait for state change to complete (e.g., device released).
+            self.pipeline.pipeline.get_state(Gst.SECOND)
 
     def __del__(self):
         self._stop()
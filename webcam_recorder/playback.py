@@ -0,0 +1,233 @@
+'''
+Frame-accurate playback of recordings.
+
+Decoded frames are kept in a memory-bounded least recently used (LRU) cache.
+Whenever a frame is read, a worker thread prefetches a window of frames
+behind and ahead of it.  The window is decoded sequentially from a single
+seek, so stepping backwards (which otherwise requires decoding from the
+previous keyframe on every step) is usually a cache hit.
+'''
+from __future__ import division
+from collections import OrderedDict, deque
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def get_cap_prop(name):
+    '''
+    Return `cv2.VideoCapture` property identifier (e.g., `POS_FRAMES`), for
+    both OpenCV 2 (`cv2.cv.CV_CAP_PROP_*`) and OpenCV 3+ (`cv2.CAP_PROP_*`).
+    '''
+    import cv2
+
+    if hasattr(cv2, 'CAP_PROP_' + name):
+        return getattr(cv2, 'CAP_PROP_' + name)
+    return getattr(cv2.cv, 'CV_CAP_PROP_' + name)
+
+
+class FrameCache(object):
+    '''
+    Least recently used cache of decoded frames, bounded by the total size of
+    frames (in bytes).
+    '''
+    def __init__(self, max_bytes=512 << 20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, index):
+        return index in self._frames
+
+    def __len__(self):
+        return len(self._frames)
+
+    def get(self, index):
+        with self._lock:
+            frame = self._frames.pop(index, None)
+            if frame is not None:
+                # Mark as most recently used.
+                self._frames[index] = frame
+            return frame
+
+    def put(self, index, frame):
+        with self._lock:
+            previous = self._frames.pop(index, None)
+            if previous is not None:
+                self.nbytes -= previous.nbytes
+            self._frames[index] = frame
+            self.nbytes += frame.nbytes
+            while self.nbytes > self.max_bytes and len(self._frames) > 1:
+                i, evicted = self._frames.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.nbytes = 0
+
+
+class VideoPlayer(object):
+    '''
+    Arguments
+    ---------
+
+     - `video_path`: Path to recording.
+     - `cache_bytes`: Maximum size (in bytes) of decoded frame cache.
+     - `behind`, `ahead`: Number of frames to prefetch behind and ahead of
+       each frame read.
+     - `batch_size`: Number of frames the prefetch worker decodes at a time
+       while holding the capture, i.e., the most frames a read of an
+       uncached frame waits for.
+     - `decode_time_count`: Number of most recent frame decode times to
+       keep.
+    '''
+    def __init__(self, video_path, cache_bytes=512 << 20, behind=30,
+                 ahead=30, batch_size=2, decode_time_count=1000):
+        import cv2
+
+        self.video_path = video_path
+        self.behind = behind
+        self.ahead = ahead
+        self.batch_size = batch_size
+        self.cache = FrameCache(cache_bytes)
+        self.capture = cv2.VideoCapture(str(video_path))
+        if not self.capture.isOpened():
+            raise IOError('Error opening video: %s' % video_path)
+        self.frame_count = int(self.capture.get(get_cap_prop('FRAME_COUNT')))
+        self.framerate = self.capture.get(get_cap_prop('FPS')) or 30.
+        self.position = 0
+        self.hits = 0
+        self.misses = 0
+        self.decoded_count = 0
+        self.decode_times = deque(maxlen=decode_time_count)
+        # Index of next frame returned by `capture.read()`.
+        self._next_index = 0
+        self._capture_lock = threading.Lock()
+        self._prefetch_request = None
+        self._prefetch_event = threading.Event()
+        self._running = True
+        self._thread = threading.Thread(target=self._prefetch_worker)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._running = False
+        self._prefetch_event.set()
+        self._thread.join()
+        self.capture.release()
+        self.cache.clear()
+
+    def _decode(self, start, stop, cancel=None):
+        '''
+        Decode frames `start` up to (but not including) `stop` into the cache
+        (seeking only if necessary), and return the last frame decoded.
+
+        The capture is held for at most `batch_size` frames at a time, so
+        other reads are not blocked while a range is decoded.  Decoding
+        stops early if `cancel()` returns `True` (checked between batches).
+        '''
+        frame = None
+        index = start
+        while index < stop:
+            if cancel is not None and cancel():
+                break
+            with self._capture_lock:
+                if index != self._next_index:
+                    self.capture.set(get_cap_prop('POS_FRAMES'), index)
+                    self._next_index = index
+                for index in range(index, min(stop, index +
+                                              self.batch_size)):
+                    start_time = time.time()
+                    success, frame = self.capture.read()
+                    if not success:
+                        self.frame_count = min(self.frame_count, index)
+                        return None
+                    self.decode_times.append(time.time() - start_time)
+                    self.decoded_count += 1
+                    self._next_index = index + 1
+                    self.cache.put(index, frame)
+                index = self._next_index
+        return frame
+
+    def read(self, index):
+        '''
+        Return decoded frame at `index` (BGR `numpy.ndarray`), or `None` if
+        index is out of range.
+        '''
+        if index < 0 or index >= self.frame_count:
+            return None
+        self.position = index
+        frame = self.cache.get(index)
+        if frame is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            frame = self._decode(index, index + 1)
+        self.prefetch(index)
+        return frame
+
+    def step(self, count=1):
+        '''
+        Return frame `count` frames from the current position (negative to
+        step backwards).
+        '''
+        index = min(max(self.position + count, 0), self.frame_count - 1)
+        return self.read(index)
+
+    def seek(self, seconds):
+        '''
+        Return frame at `seconds` from the start of the recording.
+        '''
+        return self.read(int(round(seconds * self.framerate)))
+
+    def prefetch(self, index):
+        '''
+        Request prefetch of frames around `index`.  Only the most recent
+        request is served.
+        '''
+        self._prefetch_request = index
+        self._prefetch_event.set()
+
+    def _prefetch_worker(self):
+        while self._running:
+            self._prefetch_event.wait()
+            self._prefetch_event.clear()
+            index = self._prefetch_request
+            if not self._running or index is None:
+                continue
+            # Prefetch frames ahead first, since the capture is usually
+            # positioned right after the frame read.
+            for start, stop in ((index + 1, index + 1 + self.ahead),
+                                (index - self.behind, index)):
+                start = max(0, start)
+                stop = min(self.frame_count, stop)
+                missing = [i for i in range(start, stop)
+                           if i not in self.cache]
+                if not missing or self._prefetch_event.is_set():
+                    # Nothing to fetch, or a new request is pending.
+                    continue
+                self._decode(missing[0], missing[-1] + 1,
+                             cancel=self._prefetch_event.is_set)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+    def stats(self):
+        '''
+        Return `pandas.Series` with cache hit rate, cache size and decode time
+        statistics (in seconds).
+        '''
+        decode_times = np.array(list(self.decode_times) or [np.nan])
+        return pd.Series([self.hits, self.misses, self.hit_rate,
+                          len(self.cache), self.cache.nbytes,
+                          self.decoded_count, np.nanmean(decode_times),
+                          np.nanmax(decode_times)],
+                         index=['hits', 'misses', 'hit_rate', 'cached_frames',
+                                'cached_bytes', 'decoded_frames',
+                                'decode_time_mean', 'decode_time_max'])
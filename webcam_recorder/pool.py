@@ -0,0 +1,189 @@
+'''
+Warm standby pool of preview pipelines.
+
+Building a pipeline (element factory lookups, linking, opening the device)
+and taking it from `NULL` to `PLAYING` makes every mode switch slow.  A
+`PipelinePool` pre-builds `DrawPipeline` instances for the configurations
+likely to be selected next (i.e., the neighbours of the active configuration
+in the mode list) and keeps them in the `READY` state.  A switch to a pooled
+configuration is then only a `READY` to `PLAYING` state change.
+
+The pool is bounded by a total number of pipelines and by a number of open
+device handles per device, and evicts the least recently used pipelines.
+'''
+from collections import OrderedDict
+import threading
+import time
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+import pandas as pd
+
+from .pipeline import DrawPipeline
+
+
+CONFIG_KEY_COLUMNS = ['device', 'format', 'width', 'height',
+                      'framerate_numerator', 'framerate_denominator']
+
+
+def get_config_key(device_config):
+    return tuple(device_config[c] for c in CONFIG_KEY_COLUMNS)
+
+
+class PipelinePool(object):
+    '''
+    Arguments
+    ---------
+
+     - `configs`: Mode list, i.e., frame in the format returned by
+       `caps.get_device_configs()` (in the order presented to the user).
+     - `capacity`: Maximum number of pooled pipelines.
+     - `max_device_handles`: Maximum number of pooled pipelines (i.e., open
+       device handles) per device.
+     - `radius`: Number of neighbours on each side of the active
+       configuration in `configs` to pre-build.
+    '''
+    def __init__(self, configs, capacity=4, max_device_handles=2, radius=1):
+        self.configs = configs
+        self.capacity = capacity
+        self.max_device_handles = max_device_handles
+        self.radius = radius
+        self.switches = []
+        self._pipelines = OrderedDict()
+        # Key of active (i.e., not pooled) pipeline.
+        self._active = None
+        self._recording = False
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._pipelines)
+
+    def get(self, xid, device_config):
+        '''
+        Remove and return pooled pipeline for `device_config` drawing to
+        window `xid`, or `None` if no such pipeline is pooled.
+        '''
+        with self._lock:
+            return self._pipelines.pop((xid, get_config_key(device_config)),
+                                       None)
+
+    def put(self, xid, pipeline):
+        '''
+        Set `pipeline` to the `READY` state and add it to the pool as the
+        most recently used pipeline.
+        '''
+        pipeline.pipeline.set_state(Gst.State.READY)
+        key = (xid, get_config_key(pipeline.device_config))
+        with self._lock:
+            previous = self._pipelines.pop(key, None)
+            if previous is not None and previous is not pipeline:
+                previous.pipeline.set_state(Gst.State.NULL)
+            self._pipelines[key] = pipeline
+            self._evict()
+
+    def set_active(self, xid, device_config, recording=False):
+        '''
+        Set configuration of the active pipeline (`None` if no pipeline is
+        active), which is never pre-built.
+
+        If `recording` is `True`, all pooled pipelines are released (i.e.,
+        their device handles are closed), and no pipelines are pre-built
+        until a preview configuration is active.
+        '''
+        with self._lock:
+            self._active = (None if device_config is None else
+                            (xid, get_config_key(device_config)))
+            self._recording = recording
+            if recording:
+                self.clear()
+
+    def _is_wanted(self, key):
+        return not self._recording and key != self._active
+
+    def warm(self, xid, device_config):
+        '''
+        Pre-build pipeline for `device_config` (if not already pooled).
+        '''
+        key = (xid, get_config_key(device_config))
+        with self._lock:
+            if not self._is_wanted(key):
+                return
+            if key in self._pipelines:
+                # Mark as most recently used.
+                self._pipelines[key] = self._pipelines.pop(key)
+                return
+        pipeline = DrawPipeline()
+        pipeline.run(xid, device_config=device_config, play=False)
+        with self._lock:
+            # The active configuration may have changed, or the configuration
+            # may have been pooled by another thread, while building.
+            if self._is_wanted(key) and key not in self._pipelines:
+                self.put(xid, pipeline)
+                return
+        pipeline.pipeline.set_state(Gst.State.NULL)
+
+    def prefetch(self, xid, device_config):
+        '''
+        Pre-build pipelines for the neighbours of `device_config` in the mode
+        list, in a background thread.
+        '''
+        thread = threading.Thread(target=self._prefetch,
+                                  args=(xid, device_config))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _prefetch(self, xid, device_config):
+        keys = [get_config_key(c) for i, c in self.configs.iterrows()]
+        try:
+            index = keys.index(get_config_key(device_config))
+        except ValueError:
+            return
+        # Warm furthest neighbours first, so the nearest neighbours are the
+        # most recently used (i.e., the last to be evicted).
+        for offset in range(self.radius, 0, -1):
+            for i in (index + offset, index - offset):
+                if 0 <= i < len(keys):
+                    self.warm(xid, self.configs.iloc[i])
+
+    def _evict(self):
+        device_counts = {}
+        for xid, config_key in self._pipelines:
+            device_counts[config_key[0]] = \
+                device_counts.get(config_key[0], 0) + 1
+        # Iterate from least recently used.
+        for key in list(self._pipelines):
+            device = key[1][0]
+            if (len(self._pipelines) <= self.capacity and
+                    device_counts[device] <= self.max_device_handles):
+                continue
+            self._pipelines.pop(key).pipeline.set_state(Gst.State.NULL)
+            device_counts[device] -= 1
+
+    def clear(self):
+        with self._lock:
+            for pipeline in self._pipelines.values():
+                pipeline.pipeline.set_state(Gst.State.NULL)
+            self._pipelines.clear()
+
+    def record_switch(self, device_config, hit, latency):
+        self.switches.append({'time': time.time(),
+                              'config': get_config_key(device_config),
+                              'hit': hit, 'latency': latency})
+
+    def switch_frame(self):
+        '''
+        Return `pandas.DataFrame` with one row per mode switch, including
+        whether a pooled pipeline was used (`hit`) and the time (in seconds)
+        from the switch request until the new pipeline was playing.
+        '''
+        return pd.DataFrame(self.switches,
+                            columns=['time', 'config', 'hit', 'latency'])
+
+    def latency_summary(self):
+        '''
+        Return switch latency statistics, grouped by pool hit/miss (i.e., with
+        and without a pooled pipeline).
+        '''
+        return self.switch_frame().groupby('hit')['latency'].describe()
@@ -0,0 +1,437 @@
+'''
+Process-per-camera execution mode.
+
+Each camera capture/encode pipeline runs in a dedicated worker process, such
+that Python callbacks (bus messages, pad probes, analytics) of one camera do
+not compete for the interpreter lock of another camera, and a crash of one
+worker does not affect other cameras.
+
+Preview (and analytics) frames are shared with the main process through
+shared memory, using a `shmsink` in the worker and a `shmsrc` in the main
+process.
+
+A `CameraProcessManager` provides the same interface as a `PipelineManager`
+and supervises its worker, restarting it (and continuing any recording into
+a new segment) if the worker crashes or reports an error.
+'''
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import GLib, Gst
+
+from .calibrate import get_calibrated_bitrate
+from .caps import get_bitrate, get_caps_str
+from .pipeline import DrawPipeline, RecordPipeline, next_segment_path
+from .snapshot import SnapshotMixin, SnapshotTap
+
+
+class ExecProcess(object):
+    '''
+    Worker process started by executing a fresh Python interpreter, with the
+    subset of the `multiprocessing.Process` interface used by
+    `CameraProcessManager`.
+
+    Used where `multiprocessing` can not *spawn* processes (i.e., Python 2),
+    since *forking* a process with GStreamer (and its threads) already
+    running is unsafe.  The worker is controlled through the connection
+    (socket) with file descriptor `fd`, which is inherited by the worker.
+    '''
+    def __init__(self, fd):
+        self.fd = fd
+        self.popen = None
+
+    @property
+    def pid(self):
+        return self.popen.pid if self.popen is not None else None
+
+    @property
+    def exitcode(self):
+        return self.popen.poll() if self.popen is not None else None
+
+    def start(self):
+        # Make this package importable by the worker, even if it is not
+        # installed.
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(
+            __file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([package_dir] +
+                                            [p for p in
+                                             env.get('PYTHONPATH', '')
+                                             .split(os.pathsep) if p])
+        self.popen = subprocess.Popen([sys.executable, '-m',
+                                       'webcam_recorder.process',
+                                       str(self.fd)], close_fds=False,
+                                      env=env)
+
+    def is_alive(self):
+        return self.popen is not None and self.popen.poll() is None
+
+    def join(self, timeout=None):
+        start = time.time()
+        while self.is_alive():
+            if timeout is not None and time.time() - start >= timeout:
+                break
+            time.sleep(.01)
+
+    def terminate(self):
+        if self.is_alive():
+            self.popen.terminate()
+
+
+def start_worker(*args):
+    '''
+    Start camera worker process (see `camera_worker()`) with arguments
+    following the connection argument.
+
+    Where possible, workers are *spawned* rather than *forked*, to avoid
+    forking a process with GStreamer (and its threads) already running.
+    Otherwise, a fresh interpreter is executed (see `ExecProcess`).
+
+    Returns `(conn, process)`, where `conn` is the supervisor end of the
+    control connection.
+    '''
+    if hasattr(multiprocessing, 'get_context'):
+        context = multiprocessing.get_context('spawn')
+        conn, child_conn = context.Pipe()
+        process = context.Process(target=camera_worker,
+                                  args=(child_conn, ) + args)
+        process.daemon = True
+        process.start()
+    else:
+        # Duplex pipes are socket pairs, so the worker end may be inherited
+        # by the new interpreter.
+        conn, child_conn = multiprocessing.Pipe()
+        process = ExecProcess(child_conn.fileno())
+        try:
+            process.start()
+        finally:
+            child_conn.close()
+        # Worker reads its arguments from the connection.
+        conn.send(args)
+    return conn, process
+
+
+def make_shmsink(socket_path, device_config, buffer_count=8):
+    shmsink = Gst.ElementFactory.make('shmsink', None)
+    shmsink.set_property('socket-path', socket_path)
+    # Large enough for `buffer_count` frames of up to 3 bytes per pixel.
+    shmsink.set_property('shm-size', int(buffer_count * 3 *
+                                         device_config['width'] *
+                                         device_config['height']))
+    shmsink.set_property('wait-for-connection', False)
+    shmsink.set_property('sync', False)
+    shmsink.set_property('async', False)
+    return shmsink
+
+
+def camera_worker(conn, socket_path, device_config, record_path=None,
+                  record_kwargs=None):
+    '''
+    Entry point of camera worker process.
+
+    Runs a `DrawPipeline` (or a `RecordPipeline`, if `record_path` is
+    provided) with preview frames sent to the shared memory socket at
+    `socket_path`, until a `'stop'` or `'abort'` command is received on
+    `conn`.
+    '''
+    Gst.init(None)
+    loop = GLib.MainLoop()
+    loop_thread = threading.Thread(target=loop.run)
+    loop_thread.daemon = True
+    loop_thread.start()
+
+    send_lock = threading.Lock()
+
+    def send(*message):
+        with send_lock:
+            conn.send(message)
+
+    shmsink = make_shmsink(socket_path, device_config)
+    if record_path is None:
+        pipeline = DrawPipeline()
+        pipeline.run(None, device_config=device_config, preview_sink=shmsink)
+    else:
+        pipeline = RecordPipeline()
+        pipeline.run(None, record_path, device_config=device_config,
+                     preview_sink=shmsink, **(record_kwargs or {}))
+    pipeline.bus.connect('sync-message::error', lambda bus, msg:
+                         send('error', msg.parse_error()[0].message))
+    send('started', os.getpid())
+
+    command = 'stop'
+    try:
+        while True:
+            command = conn.recv()
+            if command in ('stop', 'abort'):
+                break
+    except EOFError:
+        # Supervisor has gone away.
+        pass
+
+    if hasattr(pipeline, 'stop'):
+        if command == 'abort':
+            pipeline.abort()
+        else:
+            pipeline.stop()
+    else:
+        pipeline.pipeline.set_state(Gst.State.NULL)
+    loop.quit()
+
+
+class ShmPreviewPipeline(SnapshotMixin):
+    '''
+    Draw frames received from a camera worker process through shared memory
+    to window with the specified `xid`.
+
+    Frames are also available to the main process (e.g., for analytics)
+    through `snapshot()` and `snapshot_burst()`.
+    '''
+    def run(self, xid, socket_path, device_config):
+        self.xid = xid
+        self.pipeline = Gst.Pipeline()
+
+        self.bus = self.pipeline.get_bus()
+        self.bus.add_signal_watch()
+        self.bus.connect('message::error', self.on_error)
+        self.bus.enable_sync_message_emission()
+        self.bus.connect('sync-message::element', self.on_sync_message)
+
+        self.src = Gst.ElementFactory.make('shmsrc', None)
+        self.src.set_property('socket-path', socket_path)
+        self.src.set_property('is-live', True)
+        self.src.set_property('do-timestamp', True)
+        self.filter_ = Gst.ElementFactory.make('capsfilter', None)
+        self.filter_.set_property('caps',
+                                  Gst.Caps(get_caps_str(device_config)))
+        tee = Gst.ElementFactory.make('tee', None)
+        sink_queue = Gst.ElementFactory.make('queue', None)
+        self.sink = Gst.ElementFactory.make('autovideosink', None)
+        self.sink.set_property('sync', False)
+
+        self.snapshot_tap = SnapshotTap()
+
+        src_elements = (self.src, self.filter_, tee)
+        sink_elements = (sink_queue, self.sink)
+        snapshot_elements = self.snapshot_tap.make_elements()
+
+        for d in src_elements + sink_elements + snapshot_elements:
+            self.pipeline.add(d)
+
+        for elements in (src_elements, sink_elements, snapshot_elements):
+            for i, j in zip(elements[:-1], elements[1:]):
+                i.link(j)
+
+        tee.link(sink_elements[0])
+        tee.link(snapshot_elements[0])
+
+        self.tee = tee
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def on_sync_message(self, bus, msg):
+        if msg.get_structure().get_name() == 'prepare-window-handle':
+            msg.src.set_property('force-aspect-ratio', True)
+            msg.src.set_window_handle(self.xid)
+
+    def on_error(self, bus, msg):
+        print('on_error():', msg.parse_error())
+
+    def stop(self):
+        self.pipeline.set_state(Gst.State.NULL)
+
+
+class CameraProcessManager(object):
+    '''
+    Run a camera pipeline in a supervised worker process.
+
+    Provides the same `set_config()`/`restart()` interface as
+    `pipeline.PipelineManager`.
+
+    Arguments
+    ---------
+
+     - `start_timeout`: Time (in seconds) to wait for the worker to start.
+     - `stop_timeout`: Time (in seconds) to wait for the worker to finalize
+       any recording and exit before it is terminated.
+     - `restart_delay`: Time (in seconds) to wait before retrying to start
+       a worker that failed to restart (e.g., device still missing),
+       doubling after each failure up to `max_restart_delay`.
+    '''
+    def __init__(self, start_timeout=10., stop_timeout=3., restart_delay=1.,
+                 max_restart_delay=30.):
+        self.start_timeout = start_timeout
+        self.stop_timeout = stop_timeout
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.process = None
+        self.conn = None
+        self.preview = None
+        self.active_config = None
+        self.xid = None
+        self.record_path = None
+        self.record_kwargs = {}
+        self.socket_dir = None
+        self.failures = []
+        # Token of ongoing recovery of a failed worker (see `_recover()`).
+        self._recovering = None
+        self._lock = threading.RLock()
+
+    @property
+    def pipeline(self):
+        return self.preview
+
+    def set_config(self, xid, device_config, record_path=None,
+                   **record_kwargs):
+        with self._lock:
+            self._recovering = None
+            self._stop()
+            self._start(xid, device_config, record_path, record_kwargs)
+
+    def restart(self, record_path=None, abort=True):
+        '''
+        Stop the worker (without waiting for the source to drain, unless
+        `abort` is `False`) and start a new worker with the same
+        configuration.
+
+        If the worker is recording, the new worker records to `record_path`
+        (default: next segment path, see `pipeline.next_segment_path()`).
+        '''
+        with self._lock:
+            if self.process is None:
+                return
+            self._recovering = None
+            self._stop(command='abort' if abort else 'stop')
+            if self.record_path is not None and record_path is None:
+                record_path = str(next_segment_path(self.record_path))
+            self._start(self.xid, self.active_config, record_path,
+                        self.record_kwargs)
+
+    def _start(self, xid, device_config, record_path, record_kwargs):
+        self.active_config = device_config
+        self.xid = xid
+        self.record_path = record_path
+        self.record_kwargs = dict(record_kwargs)
+        if record_path is not None and 'bitrate' not in self.record_kwargs:
+            self.record_kwargs['bitrate'] = \
+                (get_calibrated_bitrate(device_config) or
+                 get_bitrate(device_config['height']))
+
+        self.socket_dir = tempfile.mkdtemp(prefix='webcam-recorder-')
+        socket_path = os.path.join(self.socket_dir, 'preview')
+        self.conn, self.process = start_worker(socket_path, device_config,
+                                               record_path,
+                                               self.record_kwargs)
+        if not self.conn.poll(self.start_timeout):
+            self._stop()
+            raise RuntimeError('Timed out waiting for camera worker to '
+                               'start.')
+        self.conn.recv()
+
+        self.preview = ShmPreviewPipeline()
+        self.preview.run(xid, socket_path, device_config)
+
+        monitor = threading.Thread(target=self._monitor,
+                                   args=(self.process, self.conn))
+        monitor.daemon = True
+        monitor.start()
+
+    def _monitor(self, process, conn):
+        '''
+        Restart worker if it exits unexpectedly or reports an error.
+        '''
+        while self.process is process:
+            reason = None
+            try:
+                if conn.poll(.1):
+                    message, data = conn.recv()
+                    if message == 'error':
+                        reason = 'error: %s' % data
+            except (EOFError, IOError):
+                pass
+            if reason is None and not process.is_alive():
+                reason = 'exit code: %s' % process.exitcode
+            if reason is not None:
+                self._recover(process, reason)
+                break
+
+    def _recover(self, process, reason):
+        '''
+        Replace failed worker `process`, continuing any recording into the
+        next segment.
+
+        If the new worker fails to start (e.g., the device is still missing),
+        the error is logged and starting is retried, with the delay doubling
+        after each failure, until a worker starts or the manager is
+        reconfigured.
+        '''
+        with self._lock:
+            if self.process is not process:
+                # Worker was stopped or replaced intentionally.
+                return
+            self.failures.append({'time': time.time(), 'reason': reason,
+                                  'record_path': self.record_path})
+            self._stop(command='abort')
+            record_path = self.record_path
+            if record_path is not None:
+                record_path = str(next_segment_path(record_path))
+            self._recovering = token = object()
+        delay = self.restart_delay
+        while True:
+            with self._lock:
+                if self._recovering is not token:
+                    # Manager was reconfigured meanwhile.
+                    return
+                try:
+                    self._start(self.xid, self.active_config, record_path,
+                                self.record_kwargs)
+                except Exception as exception:
+                    print('CameraProcessManager: error restarting worker: %s'
+                          % exception)
+                    self.failures.append({'time': time.time(), 'reason':
+                                          'restart error: %s' % exception,
+                                          'record_path': record_path})
+                    # Release anything started before the error.
+                    self._stop(command='abort')
+                else:
+                    self._recovering = None
+                    return
+            time.sleep(delay)
+            delay = min(2 * delay, self.max_restart_delay)
+
+    def _stop(self, command='stop'):
+        process, conn = self.process, self.conn
+        self.process = None
+        if self.preview is not None:
+            self.preview.stop()
+            self.preview = None
+        if process is not None:
+            try:
+                conn.send(command)
+            except (IOError, OSError, ValueError):
+                pass
+            process.join(self.stop_timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+            conn.close()
+        if self.socket_dir is not None:
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+            self.socket_dir = None
+
+    def __del__(self):
+        self._stop()
+
+
+if __name__ == '__main__':
+    # Camera worker executed by `ExecProcess`.
+    from _multiprocessing import Connection
+
+    conn = Connection(int(sys.argv[1]))
+    camera_worker(conn, *conn.recv())
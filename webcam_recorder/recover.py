@@ -0,0 +1,467 @@
+'''
+Recover recordings that were interrupted before the end of stream (e.g., the
+process was killed or power was lost), without re-encoding.
+
+ - `mp4`: Fragmented files (see `crash_safe` argument of
+   `RecordPipeline.run()`) are truncated after the last complete fragment.
+   Each fragment carries its own index, so no index needs to be rebuilt.
+ - `avi`: Frame chunks are scanned from the start of the `movi` list up to the
+   last complete chunk, a new `idx1` index is appended (with keyframes
+   detected from the MPEG4 frame headers), and header sizes and frame counts
+   are patched.  For OpenDML files (i.e., with `AVIX` segments, written once
+   a file grows beyond about 1GB), complete segments are kept, a standard
+   index (`ix00`) is appended to the last segment and the super index
+   (`indx`) is rebuilt.
+
+Only chunk/box headers (and the first bytes of each `avi` frame) are read,
+so even multi-gigabyte files are recovered in seconds.
+
+Usage:
+
+    python -m webcam_recorder.recover recording.mp4 [recording2.avi ...]
+'''
+import os
+import re
+import shutil
+import struct
+
+from path_helpers import path
+
+
+class RecoveryError(Exception):
+    pass
+
+
+AVIIF_KEYFRAME = 0x10
+MPEG4_VOP_START = b'\x00\x00\x01\xb6'
+MPEG4_VOL_START = b'\x00\x00\x01\x20'
+AVI_CHUNK_ID = re.compile(br'^(\d\d(dc|db|wb|pc)|ix\d\d|idx1|JUNK|LIST|'
+                          br'RIFF)$')
+
+
+def recover(input_path, output_path=None):
+    '''
+    Recover interrupted recording.
+
+    Arguments
+    ---------
+
+     - `input_path`: Path to `mp4` or `avi` recording.
+     - `output_path`: Path to write recovered file to.  If not provided, the
+       input file is repaired in place.
+
+    Returns `True` if the file was repaired, or `False` if it was already
+    complete.
+    '''
+    input_path = path(input_path)
+    if output_path is not None:
+        shutil.copyfile(input_path, output_path)
+        input_path = path(output_path)
+    ext = input_path.ext.lower()
+    if ext == '.mp4':
+        return recover_mp4(input_path)
+    elif ext == '.avi':
+        return recover_avi(input_path)
+    else:
+        raise ValueError('Unsupported file type: %s' % ext)
+
+
+def iter_mp4_boxes(f, file_size):
+    '''
+    Yield `(type, offset, size)` for each top-level box of an `mp4` file.
+
+    The last box yielded may extend beyond the end of the file (i.e., it is
+    incomplete).
+    '''
+    offset = 0
+    while offset + 8 <= file_size:
+        f.seek(offset)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        if size == 1:
+            if offset + 16 > file_size:
+                size = file_size - offset + 1
+            else:
+                size = struct.unpack('>Q', f.read(8))[0]
+        elif size == 0:
+            # Box extends to end of file.  Written by the muxer as a
+            # placeholder until the box size is known.
+            size = file_size - offset + 1
+        if size < 8:
+            raise RecoveryError('Invalid box size (%d) at offset %d.' %
+                                (size, offset))
+        yield box_type, offset, size
+        offset += size
+
+
+def recover_mp4(input_path):
+    '''
+    Truncate fragmented `mp4` file after its last complete fragment (i.e.,
+    `moof` box followed by a complete `mdat` box).
+    '''
+    file_size = os.path.getsize(input_path)
+    with open(input_path, 'rb') as f:
+        boxes = list(iter_mp4_boxes(f, file_size))
+
+    box_types = [b[0] for b in boxes]
+    if box_types and b'mfra' in box_types and \
+            boxes[-1][1] + boxes[-1][2] == file_size:
+        # Fragment index is written at end of stream.
+        return False
+    if b'moof' not in box_types:
+        if b'moov' in box_types and boxes[-1][1] + boxes[-1][2] == file_size:
+            return False
+        raise RecoveryError('No index found in `%s`.  Only `mp4` files '
+                            'recorded with `crash_safe=True` (the default) '
+                            'may be recovered.' % input_path)
+    if b'moov' not in box_types:
+        raise RecoveryError('Header (`moov`) not found in `%s`.' % input_path)
+
+    end = None
+    for i, (box_type, offset, size) in enumerate(boxes):
+        if offset + size > file_size:
+            break
+        if box_type == b'mdat' and i > 0 and boxes[i - 1][0] == b'moof':
+            end = offset + size
+        elif box_type == b'moov':
+            end = offset + size
+    if end == file_size:
+        return False
+    with open(input_path, 'r+b') as f:
+        f.truncate(end)
+    return True
+
+
+def iter_avi_chunks(f, start, end):
+    '''
+    Yield `(chunk id, offset, size)` for each chunk between `start` and `end`
+    offsets of an `avi` file, until an invalid or incomplete chunk is found.
+    '''
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        chunk_id, size = struct.unpack('<4sI', f.read(8))
+        if not AVI_CHUNK_ID.match(chunk_id):
+            return
+        if chunk_id in (b'LIST', b'RIFF'):
+            # e.g., `rec ` list or OpenDML `AVIX` extension; chunks are
+            # scanned individually.
+            size = 4
+        if offset + 8 + size > end:
+            return
+        yield chunk_id, offset, size
+        offset += 8 + size + (size & 1)
+
+
+def is_mpeg4_keyframe(data):
+    '''
+    Return `True` if MPEG4 frame data starts an intra-coded (key) frame.
+    '''
+    if MPEG4_VOL_START in data:
+        return True
+    index = data.find(MPEG4_VOP_START)
+    if index < 0 or index + 4 >= len(data):
+        return False
+    # Top two bits of byte following start code are the VOP coding type (0:
+    # intra-coded).
+    return (ord(data[index + 4:index + 5]) >> 6) == 0
+
+
+def find_avi_chunk(f, start, end, path_ids):
+    '''
+    Return `(offset, size)` of chunk found by following list types/chunk ids
+    in `path_ids` (e.g., `[b'hdrl', b'avih']`), starting from chunks between
+    offsets `start` and `end`.
+    '''
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        chunk_id, size = struct.unpack('<4sI', f.read(8))
+        if chunk_id == b'LIST':
+            list_type = f.read(4)
+            if list_type == path_ids[0]:
+                if len(path_ids) == 1:
+                    return offset, size
+                return find_avi_chunk(f, offset + 12, offset + 8 + size,
+                                      path_ids[1:])
+        elif chunk_id == path_ids[0] and len(path_ids) == 1:
+            return offset, size
+        offset += 8 + size + (size & 1)
+    return None
+
+
+def iter_riff_segments(f, file_size):
+    '''
+    Yield `(offset, size)` of each RIFF segment of an `avi` file, i.e., the
+    `AVI ` segment followed by any OpenDML `AVIX` segments (written once a
+    file grows beyond about 1GB), by following the size of each segment.
+
+    Segment sizes are only written once a recording is finished, so this is
+    only reliable for complete files (see `find_avix_segments()`).
+    '''
+    offset = 0
+    while offset + 12 <= file_size:
+        f.seek(offset)
+        riff, size, form = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or form != (b'AVI ' if offset == 0 else b'AVIX'):
+            return
+        yield offset, size
+        offset += 8 + size + (size & 1)
+
+
+def find_avix_segments(f, movi_offset, file_size):
+    '''
+    Return offsets of OpenDML `AVIX` segments, found by scanning the chunks
+    following the first `movi` list (at `movi_offset`), rather than following
+    segment sizes, since `avimux` only writes those at the end of the
+    recording.
+    '''
+    offsets = []
+    for chunk_id, offset, size in iter_avi_chunks(f, movi_offset + 12,
+                                                  file_size):
+        if chunk_id == b'RIFF':
+            f.seek(offset + 8)
+            if f.read(4) == b'AVIX':
+                offsets.append(offset)
+    return offsets
+
+
+def scan_avi_frames(f, movi_offset, end):
+    '''
+    Return `(index, end)` for frame chunks of `movi` list at `movi_offset`,
+    up to the last complete chunk before offset `end`.
+
+    `index` is a list of `(chunk id, offset, size, keyframe)` tuples and `end`
+    is the offset following the last complete chunk.
+    '''
+    index = []
+    chunks_end = movi_offset + 12
+    for chunk_id, offset, size in iter_avi_chunks(f, movi_offset + 12, end):
+        if chunk_id in (b'idx1', b'RIFF'):
+            break
+        chunks_end = offset + 8 + size + (size & 1)
+        if chunk_id[2:] not in (b'dc', b'db', b'wb', b'pc'):
+            continue
+        if chunk_id[2:] in (b'dc', b'db'):
+            f.seek(offset + 8)
+            keyframe = (chunk_id[2:] == b'db' or
+                        is_mpeg4_keyframe(f.read(min(size, 64))))
+        else:
+            keyframe = True
+        index.append((chunk_id, offset, size, keyframe))
+    return index, chunks_end
+
+
+def patch_frame_counts(f, movi_offset, first_count, total_count):
+    '''
+    Patch frame counts of main header (`dwTotalFrames`, frames of first RIFF
+    segment), video stream header (`dwLength`) and OpenDML header
+    (`dwTotalFrames`, if present).
+    '''
+    avih = find_avi_chunk(f, 12, movi_offset, [b'hdrl', b'avih'])
+    if avih is not None:
+        f.seek(avih[0] + 8 + 16)
+        f.write(struct.pack('<I', first_count))
+    strh = find_avi_chunk(f, 12, movi_offset, [b'hdrl', b'strl', b'strh'])
+    if strh is not None:
+        f.seek(strh[0] + 8)
+        if f.read(4) == b'vids':
+            f.seek(strh[0] + 8 + 32)
+            f.write(struct.pack('<I', total_count))
+    dmlh = find_avi_chunk(f, 12, movi_offset, [b'hdrl', b'odml', b'dmlh'])
+    if dmlh is not None:
+        f.seek(dmlh[0] + 8)
+        f.write(struct.pack('<I', total_count))
+
+
+def recover_avi(input_path):
+    '''
+    Rebuild index and headers of `avi` file up to its last complete chunk.
+    '''
+    file_size = os.path.getsize(input_path)
+    with open(input_path, 'r+b') as f:
+        segments = list(iter_riff_segments(f, file_size))
+        if not segments:
+            raise RecoveryError('`%s` is not an AVI file.' % input_path)
+        last_offset, last_size = segments[-1]
+        if (last_offset + 8 + last_size + (last_size & 1) == file_size and
+                (len(segments) > 1 or
+                 find_avi_chunk(f, 12, file_size, [b'idx1']) is not None)):
+            # Sizes (and index) are only written once a recording is
+            # finished.
+            return False
+        # Size of an interrupted segment may not be written yet.
+        movi = find_avi_chunk(f, 12, file_size, [b'movi'])
+        if movi is None:
+            raise RecoveryError('No frame data (`movi` list) found in `%s`.' %
+                                input_path)
+        movi_offset = movi[0]
+        avix_offsets = find_avix_segments(f, movi_offset, file_size)
+        if avix_offsets:
+            return recover_avi_odml(f, input_path, [0] + avix_offsets,
+                                    movi_offset, file_size)
+
+        index, end = scan_avi_frames(f, movi_offset, file_size)
+        if not index:
+            raise RecoveryError('No complete frames found in `%s`.' %
+                                input_path)
+        if end + 8 <= file_size:
+            f.seek(end)
+            chunk_id = f.read(4)
+            if chunk_id in (b'idx1', b'RIFF'):
+                # Truncating would drop any data that follows.
+                raise RecoveryError('Unexpected `%s` chunk at offset %d of '
+                                    '`%s`.' % (str(chunk_id.decode('ascii')),
+                                               end, input_path))
+        # Index offsets are relative to the `movi` list type.
+        movi_data = movi_offset + 8
+        if end - movi_data >= 1 << 32:
+            raise RecoveryError('Frame data of `%s` is beyond the range of an '
+                                '`idx1` index.' % input_path)
+        index_data = b''.join(struct.pack('<4sIII', chunk_id,
+                                          AVIIF_KEYFRAME if keyframe else 0,
+                                          offset - movi_data, size)
+                              for chunk_id, offset, size, keyframe in index)
+
+        f.truncate(end)
+        f.seek(end)
+        f.write(struct.pack('<4sI', b'idx1', len(index_data)) + index_data)
+        new_size = f.tell()
+
+        # Patch sizes of `RIFF` and `movi` list.
+        f.seek(4)
+        f.write(struct.pack('<I', new_size - 8))
+        f.seek(movi_offset + 4)
+        f.write(struct.pack('<I', end - movi_data))
+
+        frame_count = len([i for i in index if i[0][2:] in (b'dc', b'db')])
+        patch_frame_counts(f, movi_offset, frame_count, frame_count)
+    return True
+
+
+def recover_avi_odml(f, input_path, offsets, movi_offset, file_size):
+    '''
+    Recover OpenDML `avi` file (i.e., with `AVIX` segments at `offsets`,
+    following the first segment at offset 0), where the last segment is
+    incomplete.
+
+    Frames of complete segments are kept as they are (only the sizes of the
+    segments and their `movi` lists are patched).  Frames of the last
+    segment, up to its last complete chunk, are indexed by a new standard
+    index (`ix00`) chunk, and the super index (`indx`) of the video stream is
+    rebuilt to reference the standard index of every segment.
+
+    Raises `RecoveryError` (without modifying the file) if the file can not
+    be recovered this way.
+    '''
+    indx = find_avi_chunk(f, 12, movi_offset, [b'hdrl', b'strl', b'indx'])
+    if indx is None:
+        raise RecoveryError('No super index (`indx`) found in `%s`.' %
+                            input_path)
+    indx_offset, indx_size = indx
+    capacity = (indx_size - 24) // 16
+
+    # Standard index (`ix00`) of each complete segment, and sizes to patch.
+    std_indexes = []
+    sizes = []
+    for offset, end in zip(offsets[:-1], offsets[1:]):
+        movi = find_avi_chunk(f, offset + 12, end, [b'movi'])
+        if movi is None:
+            raise RecoveryError('No `movi` list found in segment at offset %d '
+                                'of `%s`.' % (offset, input_path))
+        ix = None
+        movi_end = movi[0] + 12
+        for chunk_id, o, s in iter_avi_chunks(f, movi[0] + 12, end):
+            if chunk_id == b'idx1':
+                break
+            movi_end = o + 8 + s + (s & 1)
+            if chunk_id == b'ix00':
+                ix = o, s
+        if ix is None:
+            raise RecoveryError('No standard index (`ix00`) found in segment '
+                                'at offset %d of `%s`.' % (offset,
+                                                           input_path))
+        ix_offset, ix_size = ix
+        f.seek(ix_offset + 8 + 4)
+        entries = struct.unpack('<I', f.read(4))[0]
+        std_indexes.append((ix_offset, 8 + ix_size, entries))
+        sizes += [(offset + 4, end - offset - 8),
+                  (movi[0] + 4, movi_end - movi[0] - 8)]
+
+    # Frames of last (incomplete) segment.
+    last_offset = offsets[-1]
+    movi = find_avi_chunk(f, last_offset + 12, file_size, [b'movi'])
+    index, end = ([], None) if movi is None else \
+        scan_avi_frames(f, movi[0], file_size)
+    if any(i[0] != b'00dc' for i in index):
+        raise RecoveryError('Only video streams of OpenDML files may be '
+                            'recovered (`%s`).' % input_path)
+    if index and end - movi[0] >= 1 << 32:
+        raise RecoveryError('Segment at offset %d of `%s` is too large.' %
+                            (last_offset, input_path))
+    if len(std_indexes) + bool(index) > capacity:
+        raise RecoveryError('Super index (`indx`) of `%s` has room for only '
+                            '%d entries.' % (input_path, capacity))
+
+    for offset, size in sizes:
+        f.seek(offset)
+        f.write(struct.pack('<I', size))
+    if not index:
+        # Drop last segment, which has no complete frames.
+        f.truncate(last_offset)
+    else:
+        # Standard index entry offsets are relative to the base offset (the
+        # `movi` list) and point to chunk data.  Bit 31 of the size marks
+        # non-key frames.
+        base = movi[0]
+        ix_data = (struct.pack('<HBBI4sQI', 2, 0, 1, len(index), b'00dc',
+                               base, 0) +
+                   b''.join(struct.pack('<II', offset + 8 - base,
+                                        size | (0 if keyframe else
+                                                1 << 31))
+                            for chunk_id, offset, size, keyframe in index))
+        f.truncate(end)
+        f.seek(end)
+        f.write(struct.pack('<4sI', b'ix00', len(ix_data)) + ix_data)
+        new_size = f.tell()
+        std_indexes.append((end, new_size - end, len(index)))
+        # Patch sizes of `RIFF` segment and `movi` list.
+        f.seek(last_offset + 4)
+        f.write(struct.pack('<I', new_size - last_offset - 8))
+        f.seek(movi[0] + 4)
+        f.write(struct.pack('<I', new_size - movi[0] - 8))
+
+    # Rebuild super index.
+    f.seek(indx_offset + 8)
+    f.write(struct.pack('<HBBI4s12x', 4, 0, 0, len(std_indexes), b'00dc'))
+    for ix_offset, ix_size, entries in std_indexes:
+        f.write(struct.pack('<QII', ix_offset, ix_size, entries))
+
+    patch_frame_counts(f, movi_offset, std_indexes[0][2],
+                       sum(i[2] for i in std_indexes))
+    return True
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Recover interrupted '
+                                     'recordings.')
+    parser.add_argument('input_path', nargs='+')
+    parser.add_argument('-o', '--output-path', help='Output path (only valid '
+                        'with a single input path).  By default, files are '
+                        'repaired in place.')
+    args = parser.parse_args()
+    if args.output_path is not None and len(args.input_path) > 1:
+        parser.error('Output path requires a single input path.')
+
+    for input_path in args.input_path:
+        start = time.time()
+        try:
+            repaired = recover(input_path, args.output_path)
+        except RecoveryError as exception:
+            print('%s: %s' % (input_path, exception))
+        else:
+            print('%s: %s (%.2f s)' % (input_path, 'recovered' if repaired
+                                       else 'complete, not modified',
+                                       time.time() - start))
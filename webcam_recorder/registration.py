@@ -0,0 +1,98 @@
+'''
+Perspective-corrected region of interest (ROI) from registration points.
+
+Registration points are saved by `view.VideoSelectorView` (HDF file, key
+`/points`, columns `image_i`, `x`, `y`), where points with `image_i == 0`
+are points in the camera frame and points with `image_i == 1` are the
+corresponding points in the rectified frame.
+
+The transform is computed once, when the pipeline is built.  The
+`perspective` element expects the *inverse* mapping (i.e., from output to
+input pixels), so the transform is inverted and translated to the origin of
+the region of interest.  The rectified region of interest is then in the top
+left corner of each frame and the remainder is cropped by `videocrop`.
+`perspective` precomputes the pixel mapping, so each frame is only remapped.
+'''
+import numpy as np
+import pandas as pd
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+
+def read_points(points_path):
+    return pd.read_hdf(str(points_path), '/points')
+
+
+def get_transform(points):
+    '''
+    Return 3x3 perspective transform matrix mapping camera frame points
+    (`image_i == 0`) to rectified points (`image_i == 1`).
+    '''
+    import cv2
+
+    src = points.loc[points.image_i == 0, ['x', 'y']].values\
+        .astype(np.float32)
+    dst = points.loc[points.image_i == 1, ['x', 'y']].values\
+        .astype(np.float32)
+    if src.shape != dst.shape or src.shape[0] < 4:
+        raise ValueError('At least 4 pairs of registration points are '
+                         'required.')
+    if src.shape[0] == 4:
+        return cv2.getPerspectiveTransform(src, dst)
+    transform, mask = cv2.findHomography(src, dst)
+    return transform
+
+
+def get_roi(points, width, height):
+    '''
+    Return `(x, y, width, height)` of bounding box of rectified points
+    (`image_i == 1`), clipped to frame size.
+
+    Width and height are rounded down to even values, as required by
+    subsampled (e.g., `I420`) encoder formats.
+    '''
+    dst = points.loc[points.image_i == 1, ['x', 'y']]
+    x0 = int(max(0, np.floor(dst.x.min())))
+    y0 = int(max(0, np.floor(dst.y.min())))
+    x1 = int(min(width, np.ceil(dst.x.max())))
+    y1 = int(min(height, np.ceil(dst.y.max())))
+    if x1 - x0 < 2 or y1 - y0 < 2:
+        raise ValueError('Region of interest is outside of frame.')
+    return x0, y0, (x1 - x0) & ~1, (y1 - y0) & ~1
+
+
+def get_roi_matrix(transform, roi):
+    '''
+    Return 3x3 matrix mapping pixels of rectified region of interest (with
+    origin at the top left of the region) to camera frame pixels.
+    '''
+    translation = np.array([[1, 0, roi[0]], [0, 1, roi[1]], [0, 0, 1]],
+                           dtype=float)
+    matrix = np.linalg.inv(transform).dot(translation)
+    return matrix / matrix[2, 2]
+
+
+def make_roi_elements(points, width, height):
+    '''
+    Return elements that rectify and crop frames of size `width`x`height`
+    to the region of interest defined by registration `points` (a
+    `pandas.DataFrame` or path to a points file).
+    '''
+    if not isinstance(points, pd.DataFrame):
+        points = read_points(points)
+    roi = get_roi(points, width, height)
+    matrix = get_roi_matrix(get_transform(points), roi)
+
+    convert_in = Gst.ElementFactory.make('videoconvert', None)
+    perspective = Gst.ElementFactory.make('perspective', None)
+    # `matrix` is a `GValueArray` property, so set it from its string form.
+    Gst.util_set_object_arg(perspective, 'matrix', '<%s>' %
+                            ', '.join('(double)%r' % float(v)
+                                      for v in matrix.ravel()))
+    crop = Gst.ElementFactory.make('videocrop', None)
+    crop.set_property('right', width - roi[2])
+    crop.set_property('bottom', height - roi[3])
+    convert_out = Gst.ElementFactory.make('videoconvert', None)
+    return convert_in, perspective, crop, convert_out
@@ -0,0 +1,243 @@
+'''
+Lossless concatenation and trimming of recordings.
+
+Recordings are only demuxed and remuxed (i.e., never decoded or re-encoded),
+so operations run at disk speed:
+
+ - `concat()`: Join compatible recordings (e.g., auto-incremented takes
+   `name1.mp4`, `name2.mp4`, ...) into a single file.
+ - `trim()`: Copy a time range of a recording, starting on the keyframe at
+   or before the requested start time.
+
+Compatibility of recordings to concatenate is checked up front, by comparing
+the video caps of each recording, including stream headers (`codec_data`).
+
+Usage:
+
+    python -m webcam_recorder.remux concat output.mp4 name1.mp4 name2.mp4
+    python -m webcam_recorder.remux trim input.mp4 output.mp4 --start 10 \\
+        --stop 20
+'''
+import threading
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+from path_helpers import path
+
+from .media import discover, get_discoverer
+from .pipeline import make_muxer
+
+
+class RemuxError(Exception):
+    pass
+
+
+#: Caps fields that may differ between compatible recordings (e.g., fields
+#: added by a parser).
+IGNORED_CAPS_FIELDS = ('parsed', 'profile', 'level')
+
+
+def get_caps_structure(caps_str):
+    '''
+    Return first structure of caps string, without fields in
+    `IGNORED_CAPS_FIELDS`.
+    '''
+    structure = Gst.Caps.from_string(caps_str).get_structure(0).copy()
+    for field in IGNORED_CAPS_FIELDS:
+        structure.remove_field(field)
+    return structure
+
+
+def check_compatible(input_paths):
+    '''
+    Check that recordings may be concatenated without re-encoding, i.e.,
+    that the video caps (codec, frame size, frame rate and stream headers)
+    of each recording match the first recording.
+
+    Returns list of media information dictionaries (see `media.discover()`).
+
+    Raises `RemuxError` describing each mismatch.
+    '''
+    discoverer = get_discoverer()
+    infos = [discover(p, discoverer) for p in input_paths]
+    for p, info in zip(input_paths, infos):
+        if 'caps' not in info:
+            raise RemuxError('No video stream found in `%s`.' % p)
+
+    reference = get_caps_structure(infos[0]['caps'])
+    errors = []
+    for p, info in zip(input_paths[1:], infos[1:]):
+        structure = get_caps_structure(info['caps'])
+        if not structure.is_equal(reference):
+            errors.append('%s: %s != %s' % (p, structure.to_string(),
+                                            reference.to_string()))
+    if errors:
+        raise RemuxError('Incompatible recordings:\n  ' + '\n  '.join(errors))
+    return infos
+
+
+def make_demuxer(input_path):
+    ext = path(input_path).ext.lower()
+    if ext in ('.mp4', '.mov'):
+        return Gst.ElementFactory.make('qtdemux', None)
+    elif ext == '.avi':
+        return Gst.ElementFactory.make('avidemux', None)
+    else:
+        raise ValueError('Unsupported input file type: %s' % ext)
+
+
+def add_input(pipeline, input_path, on_video_pad):
+    '''
+    Add `filesrc` and demuxer for `input_path` to `pipeline`, calling
+    `on_video_pad(pad)` for the video pad of the demuxer once it is added.
+    '''
+    filesrc = Gst.ElementFactory.make('filesrc', None)
+    filesrc.set_property('location', str(input_path))
+    demuxer = make_demuxer(input_path)
+    pipeline.add(filesrc)
+    pipeline.add(demuxer)
+    filesrc.link(demuxer)
+
+    def _on_pad_added(demuxer, pad):
+        if pad.get_name().startswith('video'):
+            on_video_pad(pad)
+
+    demuxer.connect('pad-added', _on_pad_added)
+    return filesrc, demuxer
+
+
+def add_output(pipeline, output_path):
+    '''
+    Add parser, muxer and `filesink` for `output_path` to `pipeline`.
+
+    Returns parser element (i.e., the input of the output branch).
+    '''
+    parser = Gst.ElementFactory.make('mpeg4videoparse', None)
+    muxer = make_muxer(output_path)
+    filesink = Gst.ElementFactory.make('filesink', None)
+    filesink.set_property('location', str(output_path))
+    # Start without waiting for preroll, since `trim()` blocks frames until
+    # it seeks.
+    filesink.set_property('async', False)
+    for e in (parser, muxer, filesink):
+        pipeline.add(e)
+    parser.link(muxer)
+    muxer.link(filesink)
+    return parser
+
+
+def run_to_eos(pipeline):
+    '''
+    Play pipeline until end of stream.
+
+    Raises `RemuxError` if an error is posted by the pipeline.
+    '''
+    bus = pipeline.get_bus()
+    pipeline.set_state(Gst.State.PLAYING)
+    try:
+        msg = bus.timed_pop_filtered(Gst.CLOCK_TIME_NONE,
+                                     Gst.MessageType.EOS |
+                                     Gst.MessageType.ERROR)
+        if msg.type == Gst.MessageType.ERROR:
+            error, debug = msg.parse_error()
+            raise RemuxError('%s (%s)' % (error.message, debug))
+    finally:
+        pipeline.set_state(Gst.State.NULL)
+
+
+def concat(input_paths, output_path, check=True):
+    '''
+    Concatenate recordings, in order, into `output_path` without
+    re-encoding.
+
+    If `check` is `True`, compatibility of recordings is checked first (see
+    `check_compatible()`).
+    '''
+    if check:
+        check_compatible(input_paths)
+
+    pipeline = Gst.Pipeline()
+    concat_ = Gst.ElementFactory.make('concat', None)
+    pipeline.add(concat_)
+    concat_.link(add_output(pipeline, output_path))
+
+    # Request pads up front, since `concat` plays its pads in the order they
+    # were requested.
+    for input_path in input_paths:
+        sink_pad = concat_.get_request_pad('sink_%u')
+        add_input(pipeline, input_path,
+                  lambda pad, sink_pad=sink_pad: pad.link(sink_pad))
+    run_to_eos(pipeline)
+
+
+def trim(input_path, output_path, start=None, stop=None):
+    '''
+    Copy the range from `start` to `stop` (in seconds) of a recording to
+    `output_path` without re-encoding.
+
+    The output starts on the keyframe at or before `start`.
+    '''
+    pipeline = Gst.Pipeline()
+    parser = add_output(pipeline, output_path)
+    linked = threading.Event()
+    blocked = {}
+
+    def _on_video_pad(pad):
+        if start or stop:
+            # Block frames until the seek, so nothing from the start of the
+            # file (and no end of stream) reaches the muxer before the seek.
+            blocked[pad] = pad.add_probe(Gst.PadProbeType.BLOCK_DOWNSTREAM |
+                                         Gst.PadProbeType.BUFFER,
+                                         lambda pad, info:
+                                         Gst.PadProbeReturn.OK)
+        pad.link(parser.get_static_pad('sink'))
+        linked.set()
+
+    add_input(pipeline, input_path, _on_video_pad)
+
+    pipeline.set_state(Gst.State.PAUSED)
+    pipeline.get_state(Gst.CLOCK_TIME_NONE)
+    if not linked.wait(10):
+        pipeline.set_state(Gst.State.NULL)
+        raise RemuxError('No video stream found in `%s`.' % input_path)
+    if start or stop:
+        stop_type = Gst.SeekType.NONE if stop is None else Gst.SeekType.SET
+        if not pipeline.seek(1., Gst.Format.TIME,
+                             Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT |
+                             Gst.SeekFlags.SNAP_BEFORE, Gst.SeekType.SET,
+                             int((start or 0) * Gst.SECOND), stop_type,
+                             int((stop or 0) * Gst.SECOND)):
+            pipeline.set_state(Gst.State.NULL)
+            raise RemuxError('Error seeking in `%s`.' % input_path)
+        for pad, probe_id in blocked.items():
+            pad.remove_probe(probe_id)
+    run_to_eos(pipeline)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Concatenate or trim '
+                                     'recordings without re-encoding.')
+    subparsers = parser.add_subparsers(dest='command')
+    concat_parser = subparsers.add_parser('concat')
+    concat_parser.add_argument('output_path')
+    concat_parser.add_argument('input_path', nargs='+')
+    concat_parser.add_argument('--no-check', action='store_true',
+                               help='Skip compatibility check.')
+    trim_parser = subparsers.add_parser('trim')
+    trim_parser.add_argument('input_path')
+    trim_parser.add_argument('output_path')
+    trim_parser.add_argument('--start', type=float, help='Start time '
+                             '(seconds).')
+    trim_parser.add_argument('--stop', type=float, help='Stop time '
+                             '(seconds).')
+    args = parser.parse_args()
+
+    Gst.init(None)
+    if args.command == 'concat':
+        concat(args.input_path, args.output_path, check=not args.no_check)
+    else:
+        trim(args.input_path, args.output_path, start=args.start,
+             stop=args.stop)
@@ -0,0 +1,178 @@
+'''
+Scan recordings for media metadata (duration, frame size, frame rate, codec,
+bit rate and file size).
+
+Recordings are discovered concurrently by a pool of worker threads, each with
+its own discoverer.  Results are stored in an on-disk cache (HDF), keyed by
+path, file size and modification time, so rescanning a directory only
+discovers new or modified recordings.
+
+Usage:
+
+    python -m webcam_recorder.scan <directory> [--cache scan.h5]
+'''
+from multiprocessing.pool import ThreadPool
+import threading
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import GLib
+import pandas as pd
+from path_helpers import path
+
+from .media import discover, get_discoverer
+
+
+#: File name patterns of recordings.
+RECORDING_PATTERNS = ('*.mp4', '*.avi')
+
+#: Columns of scan results.
+SCAN_COLUMNS = ['path', 'size', 'mtime', 'duration', 'width', 'height',
+                'framerate', 'codec', 'bitrate', 'error']
+
+#: Key of scan results in cache file.
+CACHE_KEY = '/recordings'
+
+
+def find_recordings(directory, patterns=RECORDING_PATTERNS):
+    '''
+    Return sorted list of recordings (matching any of `patterns`) found
+    recursively under `directory`.
+    '''
+    directory = path(directory)
+    return sorted(set(p.abspath() for pattern in patterns
+                      for p in directory.walkfiles(pattern)))
+
+
+def read_cache(cache_path):
+    '''
+    Return scan results stored in cache, indexed by path (empty if cache does
+    not exist).
+    '''
+    if cache_path is not None and path(cache_path).isfile():
+        try:
+            return pd.read_hdf(str(cache_path), CACHE_KEY)
+        except KeyError:
+            pass
+    return pd.DataFrame(columns=SCAN_COLUMNS).set_index('path')
+
+
+def write_cache(cache_path, df_scan):
+    df_scan = df_scan.copy()
+    # Store strings as objects (i.e., missing values as empty strings).
+    for column in ('codec', 'error'):
+        df_scan[column] = df_scan[column].fillna('').astype(str)
+    df_scan.to_hdf(str(cache_path), CACHE_KEY, format='t',
+                   data_columns=True)
+
+
+class Scanner(object):
+    '''
+    Arguments
+    ---------
+
+     - `workers`: Number of concurrent discoveries.
+     - `timeout`: Time (in seconds) allowed to discover each recording.
+    '''
+    def __init__(self, workers=4, timeout=10.):
+        self.workers = workers
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def discoverer(self):
+        # A discoverer must not be shared between threads, so create one per
+        # worker thread.
+        if not hasattr(self._local, 'discoverer'):
+            self._local.discoverer = get_discoverer(self.timeout)
+        return self._local.discoverer
+
+    def scan_file(self, file_path):
+        '''
+        Return dictionary of metadata of a recording (see `SCAN_COLUMNS`).
+        '''
+        file_path = path(file_path)
+        stat = file_path.stat()
+        result = {'path': str(file_path), 'size': stat.st_size,
+                  'mtime': stat.st_mtime}
+        try:
+            info = discover(file_path, self.discoverer)
+        except GLib.Error as exception:
+            result['error'] = exception.message
+        else:
+            result.update((k, info.get(k)) for k in SCAN_COLUMNS[3:-1])
+        return result
+
+    def scan(self, file_paths, cache_path=None):
+        '''
+        Return `pandas.DataFrame` with one row of metadata per recording in
+        `file_paths`, indexed by path.
+
+        If `cache_path` is provided, only recordings that are not in the
+        cache (or whose size or modification time changed) are discovered,
+        and the cache is updated.
+        '''
+        file_paths = [path(p).abspath() for p in file_paths]
+        df_cache = read_cache(cache_path)
+
+        stale = []
+        for p in file_paths:
+            key = str(p)
+            if key not in df_cache.index:
+                stale.append(p)
+                continue
+            stat = p.stat()
+            cached = df_cache.loc[key]
+            if (cached['size'] != stat.st_size or
+                    cached['mtime'] != stat.st_mtime):
+                stale.append(p)
+
+        if stale:
+            pool = ThreadPool(min(self.workers, len(stale)))
+            try:
+                results = pool.map(self.scan_file, stale)
+            finally:
+                pool.close()
+                pool.join()
+            df_new = pd.DataFrame(results, columns=SCAN_COLUMNS)\
+                .set_index('path')
+            df_cache = pd.concat([df_cache.drop([str(p) for p in stale],
+                                                errors='ignore'), df_new])
+            if cache_path is not None:
+                write_cache(cache_path, df_cache)
+
+        df_scan = df_cache.loc[[str(p) for p in file_paths]].copy()
+        df_scan['error'] = df_scan['error'].where(df_scan['error'] != '')
+        return df_scan
+
+
+def scan_directory(directory, cache_path=None, workers=4,
+                   patterns=RECORDING_PATTERNS):
+    '''
+    Return `pandas.DataFrame` with one row of metadata per recording found
+    under `directory` (see `Scanner.scan()`).
+    '''
+    return Scanner(workers=workers).scan(find_recordings(directory, patterns),
+                                         cache_path=cache_path)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from gi.repository import Gst
+
+    parser = argparse.ArgumentParser(description='Scan recordings for media '
+                                     'metadata.')
+    parser.add_argument('directory')
+    parser.add_argument('-c', '--cache', help='Cache file (HDF).')
+    parser.add_argument('-j', '--workers', type=int, default=4)
+    parser.add_argument('-o', '--output', help='Write results to CSV file.')
+    args = parser.parse_args()
+
+    Gst.init(None)
+    df_scan = scan_directory(args.directory, cache_path=args.cache,
+                             workers=args.workers)
+    if args.output:
+        df_scan.to_csv(args.output)
+    else:
+        print(df_scan.to_string())
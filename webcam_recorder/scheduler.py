@@ -0,0 +1,286 @@
+'''
+CPU-aware placement of pipeline streaming threads.
+
+GStreamer posts a `stream-status` message (type `ENTER`) from every new
+streaming thread, synchronously, before the thread starts processing data.
+A `CpuScheduler` handles these messages to pin each streaming thread to a
+set of CPUs and to set its priority, according to the role of the thread:
+
+ - `source`: Capture thread of the video source.
+ - `encoder`: Thread of the capture queue, which runs the encoder.
+ - `preview`: Thread of the preview queue, which runs the video sink.
+ - `snapshot`, `stream`: Snapshot and network stream branches.
+
+Encoder threads are placed on the least loaded CPUs according to a cost
+model.  The cost of each encoder is initially estimated from its pixel rate
+and is replaced by the load measured (from `/proc`) once available.  The
+number of encoder threads is set to match the number of CPUs assigned.
+
+__NB__ Thread placement is only supported on Linux.
+'''
+from __future__ import division
+import math
+import multiprocessing
+import os
+import subprocess
+import threading
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+import pandas as pd
+
+
+#: Encoder pixel rate (pixels/second) estimated to fully load one CPU.
+PIXELS_PER_CPU = 1920 * 1080 * 60
+
+#: Default `nice` value for each thread role.
+ROLE_PRIORITIES = {'source': -5, 'encoder': 0, 'preview': 5, 'stream': 5,
+                   'snapshot': 10}
+
+
+def get_thread_id():
+    '''
+    Return kernel thread identifier of the calling thread.
+    '''
+    if hasattr(threading, 'get_native_id'):
+        return threading.get_native_id()
+    # e.g., `/proc/thread-self` -> `<pid>/task/<tid>`
+    return int(os.readlink('/proc/thread-self').split('/')[-1])
+
+
+def set_thread_affinity(tid, cpus):
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(tid, cpus)
+    else:
+        subprocess.check_call(['taskset', '-p', '-c',
+                               ','.join(map(str, sorted(cpus))), str(tid)],
+                              stdout=open(os.devnull, 'w'))
+
+
+def set_thread_priority(tid, nice):
+    '''
+    Set `nice` value of thread.  Raising priority (i.e., negative `nice`)
+    requires privileges, so failures are ignored.
+    '''
+    try:
+        if hasattr(os, 'setpriority'):
+            os.setpriority(os.PRIO_PROCESS, tid, nice)
+        else:
+            subprocess.check_call(['renice', '-n', str(nice), '-p', str(tid)],
+                                  stdout=open(os.devnull, 'w'),
+                                  stderr=open(os.devnull, 'w'))
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+
+def get_thread_cpu_time(tid):
+    '''
+    Return CPU time (user + system, in seconds) used by thread of the current
+    process.
+    '''
+    with open('/proc/self/task/%d/stat' % tid) as stat:
+        # Skip process name, which may contain spaces.
+        fields = stat.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def get_thread_roles(pipeline):
+    '''
+    Return dictionary mapping elements of a `DrawPipeline` or
+    `RecordPipeline` to the role of the streaming thread they own.
+    '''
+    def upstream_element(element):
+        return element.get_static_pad('sink').get_peer().get_parent_element()
+
+    def upstream_queue(element):
+        while element.get_factory().get_name() != 'queue':
+            element = upstream_element(element)
+        return element
+
+    roles = {pipeline.src: 'source',
+             upstream_queue(pipeline.sink): 'preview'}
+    if getattr(pipeline, 'encoder', None) is not None:
+        roles[upstream_queue(pipeline.encoder)] = 'encoder'
+    if getattr(pipeline, 'snapshot_tap', None) is not None:
+        roles[pipeline.snapshot_tap.elements[0]] = 'snapshot'
+    for stream in getattr(pipeline, 'streams', []):
+        roles[stream.elements[0]] = 'stream'
+    return roles
+
+
+class CpuScheduler(object):
+    '''
+    Arguments
+    ---------
+
+     - `cpus`: CPUs available to pipelines (default: all CPUs).
+     - `priorities`: `nice` value for each thread role (default:
+       `ROLE_PRIORITIES`).
+    '''
+    def __init__(self, cpus=None, priorities=None):
+        if cpus is None:
+            if hasattr(os, 'sched_getaffinity'):
+                cpus = sorted(os.sched_getaffinity(0))
+            else:
+                cpus = range(multiprocessing.cpu_count())
+        self.cpus = list(cpus)
+        self.priorities = dict(ROLE_PRIORITIES, **(priorities or {}))
+        self.pipelines = {}
+        self.threads = {}
+        self.assignment = {}
+        self.cpu_load = {}
+        self.measured_load = {}
+        self._roles = {}
+        self._cpu_times = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, pipeline):
+        '''
+        Schedule threads of `pipeline` (a `DrawPipeline` or `RecordPipeline`)
+        under `name`.
+
+        __NB__ Must be called *before* the pipeline is played (e.g., run with
+        `play=False`), since encoder thread counts are only applied when the
+        encoder starts and streaming threads are placed as they are created.
+        '''
+        with self._lock:
+            self.pipelines[name] = pipeline
+            for element, role in get_thread_roles(pipeline).items():
+                self._roles[element] = (name, role)
+            self.plan()
+        pipeline.bus.enable_sync_message_emission()
+        pipeline.bus.connect('sync-message::stream-status',
+                             self.on_stream_status)
+
+    def remove(self, name):
+        with self._lock:
+            self.pipelines.pop(name, None)
+            self._roles = dict((e, v) for e, v in self._roles.items()
+                               if v[0] != name)
+            self.threads = dict((t, v) for t, v in self.threads.items()
+                                if v['pipeline'] != name)
+            self.plan()
+
+    def estimate_cost(self, name):
+        '''
+        Return encode cost of pipeline, in CPUs.
+        '''
+        if name in self.measured_load:
+            return self.measured_load[name]
+        pipeline = self.pipelines[name]
+        if getattr(pipeline, 'encoder', None) is None:
+            return 0
+        caps = pipeline.filter_.get_property('caps').get_structure(0)
+        success, num, denom = caps.get_fraction('framerate')
+        framerate = num / denom if success and denom else 30
+        return (caps.get_value('width') * caps.get_value('height') *
+                framerate / PIXELS_PER_CPU)
+
+    def plan(self):
+        '''
+        Assign CPUs to encoder threads, most expensive first, each to the
+        least loaded CPUs.  Preview threads are assigned to the least loaded
+        CPU remaining, and all other threads may run on any CPU.
+        '''
+        load = dict((cpu, 0.) for cpu in self.cpus)
+        costs = dict((name, self.estimate_cost(name))
+                     for name in self.pipelines)
+        assignment = {}
+        for name in sorted(costs, key=costs.get, reverse=True):
+            cost = costs[name]
+            if cost <= 0:
+                continue
+            count = min(len(self.cpus), max(1, int(math.ceil(cost))))
+            cpus = sorted(load, key=load.get)[:count]
+            for cpu in cpus:
+                load[cpu] += cost / count
+            assignment[(name, 'encoder')] = cpus
+            encoder = self.pipelines[name].encoder
+            encoder.set_property('threads', count)
+        preview_cpus = sorted(load, key=load.get)[:1]
+        for name in self.pipelines:
+            assignment[(name, 'preview')] = preview_cpus
+        self.assignment = assignment
+        self.cpu_load = load
+        return assignment
+
+    def get_cpus(self, name, role):
+        return self.assignment.get((name, role), self.cpus)
+
+    def on_stream_status(self, bus, msg):
+        status_type, owner = msg.parse_stream_status()
+        if status_type != Gst.StreamStatusType.ENTER:
+            return
+        element = owner.get_parent_element() if isinstance(owner, Gst.Pad) \
+            else owner
+        while element is not None and element not in self._roles:
+            element = element.get_parent()
+        if element is None:
+            return
+        name, role = self._roles[element]
+        # Handler runs in the new streaming thread.
+        tid = get_thread_id()
+        with self._lock:
+            self.threads[tid] = {'pipeline': name, 'role': role,
+                                 'element': element.get_name()}
+        self.apply(tid)
+
+    def apply(self, tid):
+        thread = self.threads[tid]
+        cpus = self.get_cpus(thread['pipeline'], thread['role'])
+        nice = self.priorities.get(thread['role'], 0)
+        set_thread_affinity(tid, cpus)
+        set_thread_priority(tid, nice)
+        thread['cpus'] = list(cpus)
+        thread['nice'] = nice
+
+    def measure(self):
+        '''
+        Update measured CPU load (in CPUs) of each scheduled thread since the
+        previous call, and the encode cost of each pipeline.
+        '''
+        now = os.times()[4]
+        encoder_load = {}
+        for tid, thread in list(self.threads.items()):
+            try:
+                cpu_time = get_thread_cpu_time(tid)
+            except IOError:
+                # Thread has exited.
+                self.threads.pop(tid, None)
+                continue
+            previous = self._cpu_times.get(tid)
+            self._cpu_times[tid] = (now, cpu_time)
+            if previous is None or now <= previous[0]:
+                continue
+            thread['load'] = (cpu_time - previous[1]) / (now - previous[0])
+            if thread['role'] == 'encoder':
+                encoder_load[thread['pipeline']] = \
+                    encoder_load.get(thread['pipeline'], 0) + thread['load']
+        self.measured_load.update(encoder_load)
+        return encoder_load
+
+    def rebalance(self):
+        '''
+        Re-plan using measured encoder load and re-apply placement to all
+        known threads.
+
+        __NB__ Encoder thread counts only take effect when the encoder is
+        restarted.
+        '''
+        self.measure()
+        with self._lock:
+            self.plan()
+            for tid in list(self.threads):
+                self.apply(tid)
+        return self.placement_frame()
+
+    def placement_frame(self):
+        '''
+        Return `pandas.DataFrame` with one row per scheduled thread, including
+        the assigned CPUs, `nice` value and the most recently measured load.
+        '''
+        rows = [dict(thread, tid=tid) for tid, thread in
+                self.threads.items()]
+        return pd.DataFrame(rows, columns=['pipeline', 'role', 'element',
+                                           'tid', 'cpus', 'nice', 'load'])
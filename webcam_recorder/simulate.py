@@ -0,0 +1,152 @@
+'''
+Simulated camera devices, for testing and benchmarking without hardware.
+
+Each simulated device is registered with a caps string listing its modes
+(e.g., as reported by a real camera).  `caps.get_video_sources()` lists
+registered devices along with any real devices, and `caps.get_video_source()`
+returns a live `videotestsrc` source for a simulated device, constrained to
+the registered caps.  Optionally, frame delivery is delayed by random jitter
+and the source occasionally stalls.
+
+For example, to record from 32 simulated cameras:
+
+    >>> from webcam_recorder.simulate import register_devices
+    >>> register_devices(32, jitter=.005, stall_probability=1e-3)
+    >>> device_configs = get_device_configs()
+'''
+from collections import OrderedDict
+import random
+import threading
+import time
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+
+#: Prefix of simulated device names.
+DEVICE_PREFIX = 'sim://'
+
+#: Default modes (`(width, height, framerates)`) of simulated devices.
+DEFAULT_MODES = [(320, 240, (30, 15)), (640, 480, (30, 15)),
+                 (1280, 720, (10, )), (1920, 1080, (5, ))]
+
+#: Simulated devices, by device name.
+SIMULATED_DEVICES = OrderedDict()
+_lock = threading.Lock()
+
+
+def make_caps_str(modes=DEFAULT_MODES, format='YUY2'):
+    '''
+    Return caps string with one structure per `(width, height, framerates)`
+    mode, in the format reported by camera devices.
+    '''
+    return '; '.join('video/x-raw, format=(string)%s, width=(int)%d, '
+                     'height=(int)%d, framerate=(fraction){ %s }' %
+                     (format, width, height,
+                      ', '.join('%d/1' % f for f in framerates))
+                     for width, height, framerates in modes)
+
+
+def is_simulated(device):
+    return str(device).startswith(DEVICE_PREFIX)
+
+
+def register_device(name=None, caps_str=None, pattern='smpte', jitter=0.,
+                    stall_probability=0., stall_duration=1., seed=None):
+    '''
+    Register simulated device.
+
+    Arguments
+    ---------
+
+     - `name`: Device name (default: next `SimCamNN`).
+     - `caps_str`: Caps of device modes (default: `make_caps_str()`).
+     - `pattern`: `videotestsrc` pattern.
+     - `jitter`: Maximum delay (in seconds) added to delivery of each frame.
+     - `stall_probability`: Probability of a stall on each frame.
+     - `stall_duration`: Duration (in seconds) of each stall.
+     - `seed`: Seed of random jitter and stalls.
+
+    Returns device name (e.g., `sim://usb-SimCam00-video-index0`).
+    '''
+    with _lock:
+        if name is None:
+            name = 'SimCam%02d' % len(SIMULATED_DEVICES)
+        # Follow the `/dev/v4l/by-id` naming, from which device labels are
+        # derived (see `caps.merge_device_configs()`).
+        device = '%susb-%s-video-index0' % (DEVICE_PREFIX, name)
+        SIMULATED_DEVICES[device] = {'caps_str': caps_str or make_caps_str(),
+                                     'pattern': pattern, 'jitter': jitter,
+                                     'stall_probability': stall_probability,
+                                     'stall_duration': stall_duration,
+                                     'seed': seed}
+    return device
+
+
+def register_devices(count, **kwargs):
+    '''
+    Register `count` simulated devices with the same settings (see
+    `register_device()`).  Returns list of device names.
+    '''
+    return [register_device(**kwargs) for i in range(count)]
+
+
+def unregister_device(device):
+    with _lock:
+        SIMULATED_DEVICES.pop(device, None)
+
+
+def clear_devices():
+    with _lock:
+        SIMULATED_DEVICES.clear()
+
+
+class TimingInjector(object):
+    '''
+    Buffer probe delaying frames by random jitter and occasional stalls.
+
+    The probe runs in the streaming thread of the source, so delays hold back
+    delivery of frames exactly like a slow or stalled camera.
+    '''
+    def __init__(self, jitter=0., stall_probability=0., stall_duration=1.,
+                 seed=None):
+        self.jitter = jitter
+        self.stall_probability = stall_probability
+        self.stall_duration = stall_duration
+        self.random = random.Random(seed)
+        self.stalls = 0
+
+    def __call__(self, pad, info):
+        if self.stall_probability and \
+                self.random.random() < self.stall_probability:
+            self.stalls += 1
+            time.sleep(self.stall_duration)
+        elif self.jitter:
+            time.sleep(self.random.uniform(0, self.jitter))
+        return Gst.PadProbeReturn.OK
+
+
+def make_simulated_source(device, name=None):
+    '''
+    Return source bin for simulated `device`, i.e., a live `videotestsrc`
+    constrained to the caps of the device.
+    '''
+    settings = SIMULATED_DEVICES[device]
+    bin_ = Gst.Bin.new(name)
+    src = Gst.ElementFactory.make('videotestsrc', None)
+    src.set_property('is-live', True)
+    Gst.util_set_object_arg(src, 'pattern', settings['pattern'])
+    filter_ = Gst.ElementFactory.make('capsfilter', None)
+    filter_.set_property('caps', Gst.Caps.from_string(settings['caps_str']))
+    bin_.add(src)
+    bin_.add(filter_)
+    src.link(filter_)
+    bin_.add_pad(Gst.GhostPad.new('src', filter_.get_static_pad('src')))
+
+    if settings['jitter'] or settings['stall_probability']:
+        timing = TimingInjector(settings['jitter'],
+                                settings['stall_probability'],
+                                settings['stall_duration'], settings['seed'])
+        src.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, timing)
+    return bin_
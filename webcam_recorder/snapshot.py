@@ -0,0 +1,245 @@
+'''
+Still frame snapshots from running pipelines.
+
+A `SnapshotTap` is a branch attached to the `tee` of a pipeline, ending in an
+`appsink` that keeps only the most recent frame.  Frames are only copied and
+converted when a snapshot is requested, so an idle tap costs next to nothing.
+
+Bursts of frames are copied at full rate from the streaming thread, while
+color conversion and image encoding are performed on a worker thread pool,
+such that the capture and preview branches are never stalled.
+
+Pipelines expose their tap through `SnapshotMixin`, and the preview frame
+rate limit (see `pipeline.make_preview_rate()`) through `PreviewRateMixin`.
+'''
+from multiprocessing.pool import ThreadPool
+import threading
+
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('GstVideo', '1.0')
+from gi.repository import GLib, Gst, GstVideo
+import numpy as np
+
+
+class SnapshotMixin(object):
+    '''
+    Snapshot methods of a pipeline with a `SnapshotTap` (`snapshot_tap`
+    attribute).
+    '''
+    def snapshot(self, format=None, **kwargs):
+        '''
+        Return the most recent frame (see `SnapshotTap.snapshot()`).
+        '''
+        return self.snapshot_tap.snapshot(format=format, **kwargs)
+
+    def snapshot_burst(self, count, format=None, timeout=None, **kwargs):
+        '''
+        Return the next `count` frames (see `SnapshotTap.burst()`).
+        '''
+        return self.snapshot_tap.burst(count, format=format, timeout=timeout,
+                                       **kwargs)
+
+
+class PreviewRateMixin(object):
+    '''
+    Preview frame rate limit of a pipeline with a preview `videorate`
+    element (`preview_rate` attribute).
+    '''
+    def set_preview_framerate(self, framerate=None):
+        '''
+        Limit preview to `framerate` frames/second (without affecting any
+        recording).  If `framerate` is `None`, remove limit.
+        '''
+        self.preview_rate.set_property('max-rate', int(framerate or
+                                                       GLib.MAXINT))
+
+
+class SnapshotTap(object):
+    '''
+    Arguments
+    ---------
+
+     - `workers`: Number of worker threads used to convert and encode
+       frames.
+    '''
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.elements = None
+        self.appsink = None
+        self._pool = None
+        self._burst = None
+        self._burst_count = 0
+        self._burst_done = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        return self._pool
+
+    def make_elements(self):
+        queue = Gst.ElementFactory.make('queue', None)
+        # Keep at most one pending frame, dropping older frames, to avoid
+        # holding capture buffers.
+        queue.set_property('max-size-buffers', 1)
+        queue.set_property('max-size-bytes', 0)
+        queue.set_property('max-size-time', 0)
+        queue.set_property('leaky', 2)
+        appsink = Gst.ElementFactory.make('appsink', None)
+        appsink.set_property('sync', False)
+        appsink.set_property('async', False)
+        appsink.set_property('max-buffers', 1)
+        appsink.set_property('drop', True)
+        appsink.set_property('enable-last-sample', True)
+        appsink.connect('new-sample', self.on_new_sample)
+        self.appsink = appsink
+        self.elements = (queue, appsink)
+        return self.elements
+
+    def snapshot(self, format=None, **kwargs):
+        '''
+        Return the most recent frame.
+
+        Arguments
+        ---------
+
+         - `format`: If `None`, return frame as `numpy.ndarray` in BGR channel
+           order (i.e., OpenCV convention).  Otherwise, return frame encoded as
+           `'jpeg'` or `'png'` image data.
+         - `quality`: JPEG quality (0-100, default=90).
+
+        Returns `None` if no frame has been received yet.
+        '''
+        sample = self.appsink.get_property('last-sample')
+        if sample is None:
+            return None
+        frame = sample_to_frame(sample)
+        return frame_to_array(frame) if format is None else \
+            encode_frame(frame, format, **kwargs)
+
+    def burst(self, count, format=None, timeout=None, **kwargs):
+        '''
+        Capture the next `count` frames at full rate.
+
+        Returns list of frames, in the same form as returned by `snapshot()`.
+        Conversion and encoding of each frame is started on the worker pool as
+        soon as the frame is received.
+
+        Raises `RuntimeError` if `count` frames are not received within
+        `timeout` seconds.
+        '''
+        if format is None:
+            process = frame_to_array
+        else:
+            process = lambda frame: encode_frame(frame, format, **kwargs)
+
+        with self._lock:
+            if self._burst is not None:
+                raise RuntimeError('Burst already in progress.')
+            self._burst = []
+            self._burst_count = count
+            self._burst_process = process
+            self._burst_done.clear()
+            self.appsink.set_property('emit-signals', True)
+        try:
+            if not self._burst_done.wait(timeout):
+                raise RuntimeError('Timed out waiting for %d frames (received '
+                                   '%d).' % (count, len(self._burst)))
+            return [result.get() for result in self._burst]
+        finally:
+            with self._lock:
+                self.appsink.set_property('emit-signals', False)
+                self._burst = None
+
+    def on_new_sample(self, appsink):
+        sample = appsink.emit('pull-sample')
+        with self._lock:
+            if self._burst is None or len(self._burst) >= self._burst_count:
+                return Gst.FlowReturn.OK
+            # Copy frame immediately to release the capture buffer.
+            frame = sample_to_frame(sample)
+            self._burst.append(self.pool.apply_async(self._burst_process,
+                                                     (frame, )))
+            if len(self._burst) >= self._burst_count:
+                self._burst_done.set()
+        return Gst.FlowReturn.OK
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+
+def sample_to_frame(sample):
+    '''
+    Copy raw frame data from `Gst.Sample`.
+
+    Returns `(data, video_info)` tuple, where `data` is a copy of the frame
+    data as a `numpy.ndarray` of bytes and `video_info` is the
+    `GstVideo.VideoInfo` describing the frame layout.
+    '''
+    video_info = GstVideo.VideoInfo()
+    video_info.from_caps(sample.get_caps())
+    buf = sample.get_buffer()
+    data = np.frombuffer(buf.extract_dup(0, buf.get_size()), dtype=np.uint8)
+    return data, video_info
+
+
+def frame_to_array(frame):
+    '''
+    Convert frame (as returned by `sample_to_frame()`) to `numpy.ndarray` in
+    BGR channel order.
+    '''
+    import cv2
+
+    data, video_info = frame
+    width, height = video_info.width, video_info.height
+    format_ = GstVideo.VideoFormat.to_string(video_info.finfo.format)
+
+    def plane(i, rows, columns):
+        stride = video_info.stride[i]
+        offset = video_info.offset[i]
+        return (data[offset:offset + rows * stride].reshape(rows, stride)
+                [:, :columns])
+
+    if format_ == 'I420':
+        yuv = np.concatenate([plane(0, height, width).ravel(),
+                              plane(1, height // 2, width // 2).ravel(),
+                              plane(2, height // 2, width // 2).ravel()])
+        return cv2.cvtColor(yuv.reshape(height * 3 // 2, width),
+                            cv2.COLOR_YUV2BGR_I420)
+    elif format_ == 'YUY2':
+        return cv2.cvtColor(plane(0, height, 2 * width).reshape(height, width,
+                                                                2),
+                            cv2.COLOR_YUV2BGR_YUY2)
+    elif format_ == 'BGR':
+        return plane(0, height, 3 * width).reshape(height, width, 3).copy()
+    elif format_ == 'RGB':
+        return cv2.cvtColor(plane(0, height, 3 * width).reshape(height, width,
+                                                                3),
+                            cv2.COLOR_RGB2BGR)
+    elif format_ == 'GRAY8':
+        return plane(0, height, width).copy()
+    else:
+        raise ValueError('Unsupported frame format: %s' % format_)
+
+
+def encode_frame(frame, format='jpeg', quality=90):
+    '''
+    Encode frame (as returned by `sample_to_frame()`) as `'jpeg'` or `'png'`
+    image data.
+    '''
+    import cv2
+
+    if format == 'jpeg':
+        ext, params = '.jpg', [cv2.IMWRITE_JPEG_QUALITY, quality]
+    elif format == 'png':
+        ext, params = '.png', []
+    else:
+        raise ValueError('Unsupported image format: %s' % format)
+    success, data = cv2.imencode(ext, frame_to_array(frame), params)
+    if not success:
+        raise IOError('Error encoding frame.')
+    return data.tostring()
@@ -0,0 +1,155 @@
+'''
+Network streaming outputs for `RecordPipeline`.
+
+Each stream output is a branch attached to the `tee` *after* the encoder of a
+`RecordPipeline` capture branch, i.e., the stream reuses the already encoded
+video and does not require an additional encoder.
+
+Every branch starts with a leaky queue, so a slow (or stalled) client drops
+frames from its own branch rather than blocking the encoder and, in turn, the
+file being recorded.
+'''
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+from path_helpers import path
+
+
+class StreamOutput(object):
+    '''
+    Base class for stream outputs.
+
+    Sub-classes implement `make_output_elements()` to return the elements
+    following the leaky queue of the stream branch.
+
+    Arguments
+    ---------
+
+     - `max_buffers`: Maximum number of encoded frames buffered for the
+       stream before old frames are dropped.
+    '''
+    def __init__(self, max_buffers=30):
+        self.max_buffers = max_buffers
+        self.elements = None
+
+    def make_elements(self):
+        queue = Gst.ElementFactory.make('queue', None)
+        queue.set_property('max-size-buffers', self.max_buffers)
+        queue.set_property('max-size-bytes', 0)
+        queue.set_property('max-size-time', 0)
+        # Drop oldest frames when the stream can not keep up.
+        queue.set_property('leaky', 2)
+        self.elements = (queue, ) + tuple(self.make_output_elements())
+        return self.elements
+
+    def make_output_elements(self):
+        raise NotImplementedError
+
+    def receiver_str(self):
+        '''
+        Return a `gst-launch-1.0` pipeline description that may be used by a
+        client to view the stream.
+        '''
+        raise NotImplementedError
+
+
+class UdpStream(StreamOutput):
+    '''
+    Stream encoded video as RTP over UDP to a single client at `host`:`port`.
+
+    Add one `UdpStream` per client; each client has its own leaky queue.
+    '''
+    def __init__(self, host, port, **kwargs):
+        super(UdpStream, self).__init__(**kwargs)
+        self.host = host
+        self.port = port
+
+    def make_output_elements(self):
+        payloader = Gst.ElementFactory.make('rtpmp4vpay', None)
+        # Repeat stream configuration (VOL header) to allow clients to join at
+        # any time.
+        payloader.set_property('config-interval', 1)
+        udpsink = Gst.ElementFactory.make('udpsink', None)
+        udpsink.set_property('host', self.host)
+        udpsink.set_property('port', self.port)
+        udpsink.set_property('sync', False)
+        udpsink.set_property('async', False)
+        return payloader, udpsink
+
+    def receiver_str(self):
+        return ('udpsrc port=%d caps="application/x-rtp, media=(string)video, '
+                'clock-rate=(int)90000, encoding-name=(string)MP4V-ES" ! '
+                'rtpjitterbuffer ! rtpmp4vdepay ! avdec_mpeg4 ! videoconvert '
+                '! autovideosink' % self.port)
+
+
+class TcpStream(StreamOutput):
+    '''
+    Serve encoded video as an MPEG transport stream over TCP on
+    `host`:`port`.
+
+    Any number of clients may connect.  Clients that fall behind are
+    recovered (i.e., skipped forward to the latest keyframe) by the server
+    without affecting other clients.
+    '''
+    def __init__(self, port, host='0.0.0.0', **kwargs):
+        super(TcpStream, self).__init__(**kwargs)
+        self.host = host
+        self.port = port
+
+    def make_output_elements(self):
+        parser = Gst.ElementFactory.make('mpeg4videoparse', None)
+        parser.set_property('config-interval', -1)
+        muxer = Gst.ElementFactory.make('mpegtsmux', None)
+        tcpsink = Gst.ElementFactory.make('tcpserversink', None)
+        tcpsink.set_property('host', self.host)
+        tcpsink.set_property('port', self.port)
+        tcpsink.set_property('sync', False)
+        tcpsink.set_property('async', False)
+        # Skip slow clients forward to the next keyframe.
+        Gst.util_set_object_arg(tcpsink, 'recover-policy', 'keyframe')
+        Gst.util_set_object_arg(tcpsink, 'sync-method', 'latest-keyframe')
+        return parser, muxer, tcpsink
+
+    def receiver_str(self):
+        host = '127.0.0.1' if self.host == '0.0.0.0' else self.host
+        return ('tcpclientsrc host=%s port=%d ! tsdemux ! mpeg4videoparse ! '
+                'avdec_mpeg4 ! videoconvert ! autovideosink' % (host,
+                                                              self.port))
+
+
+class HlsStream(StreamOutput):
+    '''
+    Write encoded video as an HTTP Live Streaming (HLS) playlist and MPEG
+    transport stream segments to `directory`.
+
+    The directory may be served by any HTTP server to any number of clients.
+    '''
+    def __init__(self, directory, target_duration=2, max_files=10, **kwargs):
+        super(HlsStream, self).__init__(**kwargs)
+        self.directory = path(directory)
+        self.target_duration = target_duration
+        self.max_files = max_files
+
+    @property
+    def playlist_path(self):
+        return self.directory.joinpath('playlist.m3u8')
+
+    def make_output_elements(self):
+        self.directory.makedirs_p()
+        parser = Gst.ElementFactory.make('mpeg4videoparse', None)
+        parser.set_property('config-interval', -1)
+        muxer = Gst.ElementFactory.make('mpegtsmux', None)
+        hlssink = Gst.ElementFactory.make('hlssink', None)
+        hlssink.set_property('location',
+                             str(self.directory.joinpath('segment%05d.ts')))
+        hlssink.set_property('playlist-location', str(self.playlist_path))
+        hlssink.set_property('target-duration', self.target_duration)
+        hlssink.set_property('max-files', self.max_files)
+        hlssink.set_property('playlist-length', self.max_files)
+        return parser, muxer, hlssink
+
+    def receiver_str(self):
+        return ('souphttpsrc location=http://<host>/playlist.m3u8 ! hlsdemux '
+                '! tsdemux ! mpeg4videoparse ! avdec_mpeg4 ! videoconvert ! '
+                'autovideosink')
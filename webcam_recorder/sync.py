@@ -0,0 +1,216 @@
+'''
+Synchronized recording from several cameras.
+
+Each `RecordPipeline` normally selects its own clock and base time when it is
+set to `PLAYING`, so recordings from several cameras drift relative to each
+other and start at different instants.  The `SyncRecorder` class in this
+module starts several record pipelines with:
+
+ - a *shared clock* (the system clock, a network clock, or a local clock for
+   testing), and
+ - a *common base time*,
+
+such that the running time of every pipeline is the same.  Recording to file
+begins on a common running-time boundary, and the skew between the first
+recorded frame of each camera is measured.
+'''
+import threading
+from threading import Thread
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+import pandas as pd
+
+from .pipeline import RecordPipeline
+
+
+def get_clock(kind='system', address=None, port=None, timeout=5.):
+    '''
+    Return a clock suitable for sharing between pipelines.
+
+    Arguments
+    ---------
+
+     - `kind`:
+       * `'system'`: Process-wide system clock.
+       * `'net'`: Network client clock slaved to a clock provided (e.g., using
+         `provide_clock()`) at `address`:`port`.
+       * `'local'`: Stand-alone monotonic clock instance, distinct from the
+         system clock (e.g., for testing).
+     - `address`, `port`: Address of the network clock provider (only used if
+       `kind` is `'net'`).
+     - `timeout`: Maximum time (in seconds) to wait for a network clock to
+       synchronize.
+    '''
+    if kind == 'system':
+        return Gst.SystemClock.obtain()
+    elif kind == 'net':
+        gi.require_version('GstNet', '1.0')
+        from gi.repository import GstNet
+
+        if address is None or port is None:
+            raise ValueError('Address and port are required for a network '
+                             'clock.')
+        clock = GstNet.NetClientClock.new('webcam-recorder', address, port, 0)
+        if not clock.wait_for_sync(int(timeout * Gst.SECOND)):
+            raise RuntimeError('Timed out synchronizing with network clock '
+                               'at %s:%s' % (address, port))
+        return clock
+    elif kind == 'local':
+        clock = Gst.SystemClock()
+        clock.set_property('clock-type', Gst.ClockType.MONOTONIC)
+        return clock
+    else:
+        raise ValueError('Unsupported clock type: %s' % kind)
+
+
+def provide_clock(clock=None, address=None, port=0):
+    '''
+    Expose `clock` (default: system clock) on the network, so that recorders
+    on other hosts may use it through `get_clock('net', ...)`.
+
+    Returns the `GstNet.NetTimeProvider`, which must be kept alive for as long
+    as the clock should be provided.  The selected port is available through
+    the `port` property of the provider.
+    '''
+    gi.require_version('GstNet', '1.0')
+    from gi.repository import GstNet
+
+    if clock is None:
+        clock = Gst.SystemClock.obtain()
+    return GstNet.NetTimeProvider.new(clock, address, port)
+
+
+class SyncRecorder(object):
+    '''
+    Record from several cameras using a shared clock and a common base time.
+
+    Example
+    -------
+
+        recorder = SyncRecorder(get_clock('system'))
+        recorder.start([{'xid': xid_i, 'output_path': 'camera%d.mp4' % i,
+                         'device_config': config_i}
+                        for i, (xid_i, config_i) in enumerate(...)])
+        ...
+        recorder.stop()
+        print recorder.skew_frame()
+
+    Arguments
+    ---------
+
+     - `clock`: Clock shared by all pipelines (default: system clock).
+     - `start_delay`: Time (in seconds) allowed for all pipelines to reach the
+       `PLAYING` state before recording starts.
+     - `boundary`: Recording starts on the first multiple of `boundary` (in
+       seconds of running time) after `start_delay` has elapsed.
+    '''
+    def __init__(self, clock=None, start_delay=1., boundary=1.):
+        self.clock = clock if clock is not None else get_clock('system')
+        self.start_delay = start_delay
+        self.boundary = boundary
+        self.pipelines = []
+        self.cameras = []
+        self.base_time = None
+        self.record_start = None
+        self._first_pts = {}
+        self._started = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self, cameras):
+        '''
+        Start one `RecordPipeline` per camera, in parallel.
+
+        Arguments
+        ---------
+
+         - `cameras`: List of dictionaries, each containing keyword arguments
+           for `RecordPipeline.run()` (i.e., `xid`, `output_path` and,
+           optionally, `device_config` and `bitrate`).
+        '''
+        self.cameras = list(cameras)
+        self.pipelines = [RecordPipeline() for c in self.cameras]
+        self._first_pts = {}
+        self._started.clear()
+
+        # All pipelines share the same base time, so the running time (i.e.,
+        # clock time - base time) is the same in every pipeline.
+        self.base_time = self.clock.get_time()
+        boundary = int(self.boundary * Gst.SECOND)
+        start = int(self.start_delay * Gst.SECOND)
+        self.record_start = ((start + boundary - 1) // boundary) * boundary
+
+        def _run(i, pipeline, camera):
+            kwargs = dict(camera)
+            kwargs.update(clock=self.clock, base_time=self.base_time,
+                          play=False)
+            pipeline.run(**kwargs)
+            # Drop frames in capture branch until the common start time.
+            pad = pipeline.capture_elements[0].get_static_pad('sink')
+            pad.add_probe(Gst.PadProbeType.BUFFER, self._record_start_probe,
+                          i)
+            pipeline.play()
+
+        self._run_parallel(_run)
+
+    def stop(self):
+        '''
+        Stop all pipelines, in parallel.
+        '''
+        self._run_parallel(lambda i, pipeline, camera: pipeline.stop())
+
+    def _run_parallel(self, target):
+        threads = [Thread(target=target, args=(i, pipeline_i, camera_i))
+                   for i, (pipeline_i, camera_i) in
+                   enumerate(zip(self.pipelines, self.cameras))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+
+    def _record_start_probe(self, pad, info, i):
+        buf = info.get_buffer()
+        # Live sources time stamp buffers with the pipeline running time.
+        if buf.pts == Gst.CLOCK_TIME_NONE or buf.pts < self.record_start:
+            return Gst.PadProbeReturn.DROP
+        with self._lock:
+            self._first_pts[i] = buf.pts
+            if len(self._first_pts) == len(self.pipelines):
+                self._started.set()
+        return Gst.PadProbeReturn.REMOVE
+
+    def wait_started(self, timeout=None):
+        '''
+        Wait until every camera has recorded its first frame.
+
+        Returns `True` if all cameras started within `timeout` seconds.
+        '''
+        return self._started.wait(timeout)
+
+    def skew_frame(self):
+        '''
+        Return a `pandas.DataFrame` with one row per camera, containing the
+        running time (in seconds) of the first recorded frame and its offset
+        relative to the recording start boundary and to the earliest camera.
+        '''
+        rows = []
+        for i, camera_i in enumerate(self.cameras):
+            pts = self._first_pts.get(i)
+            rows.append({'output_path': camera_i.get('output_path'),
+                         'first_pts': (float(pts) / Gst.SECOND
+                                       if pts is not None else None)})
+        df = pd.DataFrame(rows, columns=['output_path', 'first_pts'])
+        df['offset'] = df.first_pts - float(self.record_start) / Gst.SECOND
+        df['skew'] = df.first_pts - df.first_pts.min()
+        return df
+
+    @property
+    def skew(self):
+        '''
+        Maximum difference (in seconds) between the first recorded frame of
+        any two cameras.
+        '''
+        df = self.skew_frame()
+        return df.first_pts.max() - df.first_pts.min()
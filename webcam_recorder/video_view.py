@@ -10,6 +10,7 @@ from pygtk3_helpers.delegates import SlaveView
 from pygtk3_helpers.file_chooser import FileChooserView
 from path_helpers import path
 from .pipeline import PipelineManager
+from .pool import PipelinePool
 from .caps import get_device_configs
 
 
@@ -98,8 +99,12 @@ class VideoView(SlaveView):
 
 
 class RecordView(SlaveView):
-    def __init__(self, device_configs=None):
+    def __init__(self, device_configs=None, pool_capacity=0):
         self.video_view = None
+        # Number of preview pipelines for neighbouring modes to keep warm for
+        # fast switching (disabled by default, since each pooled pipeline
+        # keeps a device handle open).
+        self.pool_capacity = pool_capacity
         super(RecordView, self).__init__()
         if device_configs is None:
             self.device_configs = get_device_configs()
@@ -120,6 +125,10 @@ class RecordView(SlaveView):
             slave.show()
             self.add_slave(slave)
         self.record_control.on_changed = self.on_options_changed
+        if self.pool_capacity:
+            self.pipeline_manager.pool = \
+                PipelinePool(self.record_control.device_configs,
+                             capacity=self.pool_capacity)
 
         # Pack load and save sections to end of row.
         self.widget.set_child_packing(self.record_control.widget, False, False,
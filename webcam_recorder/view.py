@@ -236,3 +236,89 @@ class RegistrationView(SlaveView):
     def reset(self):
         for p in self.points:
             p.reset()
+
+
+class PlaybackView(SlaveView):
+    '''
+    Step through, scrub and seek recordings frame by frame (see
+    `playback.VideoPlayer`).
+    '''
+    def __init__(self, *args, **kwargs):
+        self.cache_bytes = kwargs.pop('cache_bytes', 512 << 20)
+        super(PlaybackView, self).__init__(*args, **kwargs)
+        self.player = None
+        self.image = None
+
+    def create_ui(self):
+        filters = [{'name': 'Video (*.mp4, *.avi)', 'pattern': ['*.mp4', '*.avi']}]
+        self.video_selector = FileChooserView(editable=False, filters=filters)
+        self.video_selector.show()
+        self.video_selector.on_selected = self.on_selected
+        self.add_slave(self.video_selector)
+        self.widget.set_child_packing(self.video_selector.widget, False, False, 0,
+                                      Gtk.PackType.START)
+
+        self.fig = Figure(figsize=(8, 6), dpi=100)
+        self.axis = self.fig.add_subplot(111)
+        canvas = FigureCanvas(self.fig)
+        canvas.set_size_request(640, 480)
+        self.widget.pack_start(canvas, True, True, 0)
+
+        controls = Gtk.HBox()
+        self.buttons = {}
+        for label, count in (('<<', -10), ('<', -1), ('>', 1), ('>>', 10)):
+            button = Gtk.Button(label)
+            button.connect('clicked', lambda button, count=count:
+                           self.show_frame(self.player.position + count))
+            controls.pack_start(button, False, False, 0)
+            self.buttons[label] = button
+        self.scale = Gtk.Scale.new_with_range(Gtk.Orientation.HORIZONTAL, 0,
+                                              1, 1)
+        self.scale.set_digits(0)
+        self.scale.connect('value-changed', self.on_scale_changed)
+        controls.pack_start(self.scale, True, True, 0)
+        self.widget.pack_start(controls, False, False, 0)
+
+        self.stats_label = Gtk.Label()
+        self.widget.pack_start(self.stats_label, False, False, 0)
+        self.widget.show_all()
+
+    def on_selected(self, value):
+        from .playback import VideoPlayer
+
+        if self.player is not None:
+            self.player.close()
+        self.player = VideoPlayer(value, cache_bytes=self.cache_bytes)
+        self.axis.clear()
+        self.image = None
+        self.scale.set_range(0, max(1, self.player.frame_count - 1))
+        self.show_frame(0)
+
+    def on_scale_changed(self, scale):
+        # Ignore changes made by `show_frame()`.
+        if (self.player is not None and
+                int(scale.get_value()) != self.player.position):
+            self.show_frame(int(scale.get_value()))
+
+    def show_frame(self, index):
+        if self.player is None:
+            return
+        index = min(max(index, 0), self.player.frame_count - 1)
+        frame = self.player.read(index)
+        if frame is None:
+            return
+        # Frames are decoded as BGR.
+        if self.image is None:
+            self.image = self.axis.imshow(frame[..., ::-1])
+        else:
+            self.image.set_data(frame[..., ::-1])
+        if int(self.scale.get_value()) != index:
+            self.scale.set_value(index)
+        self.fig.canvas.draw()
+        stats = self.player.stats()
+        self.stats_label.set_text('Frame %d/%d    cache hit rate: %s    '
+                                  'decode: %.1f ms/frame' %
+                                  (index, self.player.frame_count - 1,
+                                   '-' if pd.isnull(stats.hit_rate) else
+                                   '%.0f%%' % (100 * stats.hit_rate),
+                                   1e3 * stats.decode_time_mean))
@@ -0,0 +1,218 @@
+'''
+Detect stalled or failed camera pipelines and recover automatically.
+
+A `PipelineWatchdog` monitors the active pipeline of a `PipelineManager`:
+
+ - *Stalls* are detected from the absence of buffers at the source pad for
+   longer than `stall_timeout` seconds (by default, several frame intervals
+   of the active configuration).
+ - *Errors* are detected from `error` messages posted on the pipeline bus.
+
+On either condition, only the affected pipeline is torn down (finalizing the
+current recording) and rebuilt.  Recording continues into a new segment file
+(see `pipeline.next_segment_path()`), and a gap marker is appended to a gap
+log next to the recording.
+'''
+from __future__ import division
+from datetime import datetime
+import threading
+import time
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+import pandas as pd
+from path_helpers import path
+
+
+GAP_COLUMNS = ['reason', 'previous_path', 'next_path', 'gap_start',
+               'detected', 'recovered', 'gap_duration', 'recovery_time']
+
+
+def get_gap_log_path(record_path):
+    '''
+    Return path of gap log for recording, e.g., `name.gaps.csv` for
+    `name.mp4` or `name_seg2.mp4`.
+    '''
+    record_path = path(record_path)
+    namebase = record_path.namebase.split('_seg')[0]
+    return record_path.parent.joinpath(namebase + '.gaps.csv')
+
+
+class PipelineWatchdog(object):
+    '''
+    Arguments
+    ---------
+
+     - `manager`: `PipelineManager` to monitor.
+     - `stall_timeout`: Time (in seconds) without buffers from the source
+       before the pipeline is considered stalled.  By default,
+       `stall_frames` frame intervals of the active configuration, but at
+       least `min_stall_timeout`.
+     - `startup_timeout`: Time (in seconds) allowed for a new pipeline to
+       produce its first buffer.
+     - `check_interval`: Time (in seconds) between checks.
+    '''
+    def __init__(self, manager, stall_timeout=None, startup_timeout=5.,
+                 check_interval=.1, stall_frames=10, min_stall_timeout=1.):
+        self.manager = manager
+        self.stall_timeout = stall_timeout
+        self.stall_frames = stall_frames
+        self.min_stall_timeout = min_stall_timeout
+        self.startup_timeout = startup_timeout
+        self.check_interval = check_interval
+        self.gaps = []
+        self._pipeline = None
+        self._attached = None
+        self._last_buffer = None
+        self._error = None
+        self._pending_gap = None
+        self._thread = None
+        self._running = threading.Event()
+        self._first_buffer = threading.Event()
+
+    def start(self):
+        self._running.set()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running.clear()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def gap_frame(self):
+        '''
+        Return `pandas.DataFrame` with one row per recovered gap.
+        '''
+        return pd.DataFrame(self.gaps, columns=GAP_COLUMNS)
+
+    def _attach(self, pipeline):
+        self._pipeline = pipeline
+        self._attached = time.time()
+        self._last_buffer = None
+        self._error = None
+        self._first_buffer.clear()
+        pad = pipeline.src.get_static_pad('src')
+        pad.add_probe(Gst.PadProbeType.BUFFER, self._on_buffer)
+        # Sync messages are emitted from the posting thread, i.e., no main
+        # loop is required.
+        pipeline.bus.enable_sync_message_emission()
+        pipeline.bus.connect('sync-message::error', self._on_error)
+
+    def _on_buffer(self, pad, info):
+        self._last_buffer = time.time()
+        self._first_buffer.set()
+        return Gst.PadProbeReturn.OK
+
+    def _on_error(self, bus, msg):
+        self._error = msg.parse_error()
+
+    def get_stall_timeout(self):
+        '''
+        Return stall timeout (in seconds) for the active configuration.
+        '''
+        if self.stall_timeout is not None:
+            return self.stall_timeout
+        config = self.manager.active_config
+        framerate = config['framerate'] if config is not None else None
+        if not framerate:
+            return self.min_stall_timeout
+        return max(self.min_stall_timeout, self.stall_frames / framerate)
+
+    def _check(self):
+        '''
+        Return reason the pipeline needs to be recovered, or `None`.
+        '''
+        if self._error is not None:
+            return 'error: %s' % (self._error[0].message, )
+        now = time.time()
+        if self._last_buffer is None:
+            if now - self._attached > self.startup_timeout:
+                return 'no buffers'
+        elif now - self._last_buffer > self.get_stall_timeout():
+            return 'stall'
+        return None
+
+    def _run(self):
+        while self._running.is_set():
+            pipeline = self.manager.pipeline
+            if pipeline is not None and hasattr(pipeline, 'src'):
+                if pipeline is not self._pipeline:
+                    self._attach(pipeline)
+                if (self._pending_gap is not None and
+                        self._last_buffer is not None):
+                    # Pipeline recovered after `recover()` stopped waiting.
+                    self._end_gap()
+                reason = self._check()
+                if reason is not None:
+                    try:
+                        self.recover(reason)
+                    except Exception as exception:
+                        # e.g., device not available yet.  Retry once the
+                        # startup timeout has elapsed again.
+                        print('PipelineWatchdog: error recovering from %s: '
+                              '%s' % (reason, exception))
+                        self._attached = time.time()
+                        self._last_buffer = None
+                        self._error = None
+            time.sleep(self.check_interval)
+
+    def recover(self, reason):
+        '''
+        Tear down and rebuild the monitored pipeline.
+
+        If the previous pipeline received any buffers, recording continues in
+        a new segment file.  Otherwise, the same output path is reused.
+
+        The gap is recorded once a rebuilt pipeline delivers its first
+        buffer.  Until then (e.g., while a USB camera reconnects), the gap
+        stays pending across retries, so it starts at the original stall.
+        '''
+        if self._pending_gap is None:
+            self._pending_gap = {'reason': reason,
+                                 'previous_path': self.manager.record_path,
+                                 'gap_start': (self._last_buffer
+                                               if self._last_buffer is not
+                                               None else self._attached),
+                                 'detected': time.time()}
+        next_path = (None if self._last_buffer is not None
+                     else self.manager.record_path)
+
+        self.manager.restart(record_path=next_path)
+        self._attach(self.manager.pipeline)
+        if self._first_buffer.wait(self.startup_timeout):
+            self._end_gap()
+        # Otherwise, leave the new pipeline to be recovered again by the next
+        # check.
+
+    def _end_gap(self):
+        '''
+        Record pending gap, ended by the first buffer of the rebuilt
+        pipeline.
+        '''
+        pending, self._pending_gap = self._pending_gap, None
+        recovered = self._last_buffer
+        gap = {'reason': pending['reason'],
+               'previous_path': pending['previous_path'],
+               'next_path': self.manager.record_path,
+               'gap_start': datetime.fromtimestamp(pending['gap_start']),
+               'detected': datetime.fromtimestamp(pending['detected']),
+               'recovered': datetime.fromtimestamp(recovered),
+               'gap_duration': recovered - pending['gap_start'],
+               'recovery_time': recovered - pending['detected']}
+        self.gaps.append(gap)
+        if gap['previous_path'] is not None:
+            self.write_gap(gap)
+
+    def write_gap(self, gap):
+        '''
+        Append gap marker to the gap log of the recording.
+        '''
+        log_path = get_gap_log_path(gap['previous_path'])
+        pd.DataFrame([gap], columns=GAP_COLUMNS).to_csv(log_path, mode='a',
+                                                        index=False,
+                                                        header=not
+                                                        log_path.isfile())
@@ -0,0 +1,389 @@
+'''
+Buffered file output for recordings.
+
+A `BufferedFileSink` replaces `filesink` at the end of a capture branch.
+Instead of writing from the streaming thread (where a write latency spike
+stalls the muxer and backs up the capture queue), data is appended to an
+in-memory buffer and written by a dedicated writer thread (see
+`BufferedWriter`):
+
+ - Data is coalesced into large writes aligned to `block_size` file offsets.
+ - Muxer seeks (e.g., `mp4mux` rewriting the header at the end of the
+   recording) are applied in order with the data.
+ - Files are synced to disk according to an `fsync` policy.
+ - Write throughput and latency are recorded (see `BufferedWriter.stats()`).
+
+The buffer fill level (`fill`, fraction of `buffer_size`) is the
+backpressure signal.  When it rises above `high_watermark`, the sink posts a
+`writer-backpressure` element message (`active=true`), and again when it
+falls below `low_watermark` (`active=false`).  The streaming thread only
+blocks if the buffer is completely full.
+'''
+from __future__ import division
+from collections import deque
+import os
+import threading
+import time
+
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('GstBase', '1.0')
+from gi.repository import GLib, GObject, Gst, GstBase
+import pandas as pd
+
+
+#: File sync policies.
+FSYNC_POLICIES = ('never', 'close', 'interval')
+
+
+class BufferedWriter(object):
+    '''
+    Arguments
+    ---------
+
+     - `file_path`: Output file path.
+     - `buffer_size`: Maximum size (in bytes) of buffered data.
+     - `block_size`: Size (in bytes) of write blocks.  Buffered data is
+       written once a block (aligned to the file offset) is complete.
+     - `max_delay`: Maximum time (in seconds) data may remain buffered
+       before it is written, even if less than a block is buffered.
+     - `fsync`: File sync policy (see `FSYNC_POLICIES`).
+     - `fsync_interval`: Time (in seconds) between syncs for `interval`
+       policy.
+     - `latency_count`: Number of most recent write latencies to keep.
+    '''
+    def __init__(self, file_path, buffer_size=64 << 20, block_size=1 << 20,
+                 max_delay=1., fsync='close', fsync_interval=1.,
+                 latency_count=1000):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Unsupported fsync policy: %s (must be one of '
+                             '%s)' % (fsync, ', '.join(FSYNC_POLICIES)))
+        if buffer_size < block_size:
+            raise ValueError('Buffer size (%d) must be at least the block '
+                             'size (%d).' % (buffer_size, block_size))
+        self.file_path = file_path
+        self.buffer_size = buffer_size
+        self.block_size = block_size
+        self.max_delay = max_delay
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.pending_bytes = 0
+        self.max_pending_bytes = 0
+        self.bytes_written = 0
+        self.write_count = 0
+        self.write_time = 0.
+        self.fsync_count = 0
+        self.latencies = deque(maxlen=latency_count)
+        self.error = None
+        self._ops = deque()
+        self._condition = threading.Condition()
+        self._flush = False
+        self._closed = False
+        self._position = 0
+        self._last_sync = None
+        self._start_time = None
+        self._file = None
+        self._thread = None
+
+    @property
+    def fill(self):
+        return self.pending_bytes / self.buffer_size
+
+    def open(self):
+        # Unbuffered, since writes are already coalesced.
+        self._file = open(self.file_path, 'wb', 0)
+        self._start_time = time.time()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, data):
+        '''
+        Append `data` to the buffer, blocking while the buffer is full.
+        '''
+        with self._condition:
+            while (self.pending_bytes and self.error is None and
+                   self.pending_bytes + len(data) > self.buffer_size):
+                self._condition.wait()
+            if self.error is not None:
+                raise self.error
+            self._ops.append(('data', data))
+            self.pending_bytes += len(data)
+            self.max_pending_bytes = max(self.max_pending_bytes,
+                                         self.pending_bytes)
+            self._condition.notify_all()
+
+    def seek(self, offset):
+        '''
+        Write subsequent data at `offset` (after all data buffered so far is
+        written).
+        '''
+        with self._condition:
+            self._ops.append(('seek', offset))
+            self._condition.notify_all()
+
+    def flush(self, sync=False):
+        '''
+        Wait until all buffered data is written, and sync file to disk if
+        `sync` is `True`.
+        '''
+        with self._condition:
+            if sync:
+                self._ops.append(('sync', None))
+            self._flush = True
+            self._condition.notify_all()
+            while (self._ops or self.pending_bytes) and self.error is None:
+                self._condition.wait()
+            self._flush = False
+            if self.error is not None:
+                raise self.error
+
+    def close(self):
+        if self._thread is None:
+            return
+        try:
+            self.flush(sync=self.fsync != 'never')
+        finally:
+            with self._condition:
+                self._closed = True
+                self._condition.notify_all()
+            self._thread.join()
+            self._thread = None
+            self._file.close()
+
+    def _next_ops(self):
+        '''
+        Wait for operations to perform.
+
+        Returns `(ops, force)`, where `ops` is a list of `(op, value)`
+        tuples (with consecutive data joined) and `force` is `True` if all
+        data must be written (i.e., flushing, or data has been buffered for
+        longer than `max_delay`).  Returns `None` once closed.
+        '''
+        with self._condition:
+            force = False
+            while True:
+                if self._closed:
+                    return None
+                if self._ops and (self._flush or
+                                  any(op != 'data' for op, v in self._ops) or
+                                  self._position % self.block_size +
+                                  self.pending_bytes >= self.block_size):
+                    break
+                if not self._condition.wait(self.max_delay) and self._ops:
+                    # Timed out waiting for a complete block.
+                    force = True
+                    break
+            force = force or self._flush
+            ops = list(self._ops)
+            self._ops.clear()
+        joined = []
+        for op, value in ops:
+            if op == 'data' and joined and joined[-1][0] == 'data':
+                joined[-1][1].append(value)
+            elif op == 'data':
+                joined.append(('data', [value]))
+            else:
+                joined.append((op, value))
+        return ([(op, b''.join(value) if op == 'data' else value)
+                 for op, value in joined], force)
+
+    def _write(self, data):
+        start = time.time()
+        self._file.write(data)
+        end = time.time()
+        self._position += len(data)
+        self.latencies.append(end - start)
+        self.write_time += end - start
+        self.bytes_written += len(data)
+        self.write_count += 1
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.fsync_count += 1
+        self._last_sync = time.time()
+
+    def _run(self):
+        self._last_sync = time.time()
+        while True:
+            next_ops = self._next_ops()
+            if next_ops is None:
+                break
+            ops, force = next_ops
+            held = b''
+            try:
+                for i, (op, value) in enumerate(ops):
+                    if op == 'data':
+                        if i == len(ops) - 1 and not force:
+                            # Hold back data following the last complete
+                            # block, to keep writes aligned.
+                            end = self._position + len(value)
+                            aligned = len(value) - end % self.block_size
+                            if aligned > 0:
+                                held = value[aligned:]
+                                value = value[:aligned]
+                        self._write(value)
+                        with self._condition:
+                            self.pending_bytes -= len(value)
+                            self._condition.notify_all()
+                    elif op == 'seek':
+                        self._file.seek(value)
+                        self._position = value
+                    elif op == 'sync':
+                        self._sync()
+                if self.fsync == 'interval' and \
+                        time.time() - self._last_sync >= self.fsync_interval:
+                    self._sync()
+            except (IOError, OSError) as exception:
+                with self._condition:
+                    self.error = exception
+                    self._condition.notify_all()
+                return
+            with self._condition:
+                if held:
+                    # Return held data to the front of the buffer.
+                    self._ops.appendleft(('data', held))
+                self._condition.notify_all()
+
+    def stats(self):
+        '''
+        Return `pandas.Series` with write throughput (bytes/second, while
+        writing and overall), write latency statistics (in seconds) and
+        buffer usage.
+        '''
+        latencies = pd.Series(list(self.latencies))
+        elapsed = time.time() - self._start_time if self._start_time else 0
+        return pd.Series([self.file_path, self.bytes_written,
+                          self.write_count,
+                          self.bytes_written / self.write_time
+                          if self.write_time else None,
+                          self.bytes_written / elapsed if elapsed else None,
+                          latencies.mean(), latencies.quantile(.99)
+                          if latencies.size else None, latencies.max(),
+                          self.fsync_count, self.pending_bytes,
+                          self.max_pending_bytes, self.fill],
+                         index=['file_path', 'bytes_written', 'write_count',
+                                'write_throughput', 'throughput',
+                                'latency_mean', 'latency_99', 'latency_max',
+                                'fsync_count', 'pending_bytes',
+                                'max_pending_bytes', 'fill'])
+
+
+class BufferedFileSink(GstBase.BaseSink):
+    '''
+    Sink writing to file through a `BufferedWriter`.
+
+    Arguments
+    ---------
+
+     - `location`: Output file path.
+     - `high_watermark`, `low_watermark`: Buffer fill levels (fraction) at
+       which backpressure is signalled and cleared.
+
+    Other keyword arguments are passed to `BufferedWriter`.
+    '''
+    __gstmetadata__ = ('Buffered file sink', 'Sink/File',
+                       'Write to file from a dedicated writer thread',
+                       'webcam-recorder')
+    __gsttemplates__ = Gst.PadTemplate.new('sink', Gst.PadDirection.SINK,
+                                           Gst.PadPresence.ALWAYS,
+                                           Gst.Caps.new_any())
+
+    def __init__(self, location, high_watermark=.75, low_watermark=.25,
+                 **kwargs):
+        super(BufferedFileSink, self).__init__()
+        self.set_sync(False)
+        self.location = location
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.writer_kwargs = kwargs
+        # Check writer arguments (e.g., sizes) up front.
+        BufferedWriter(location, **kwargs)
+        self.writer = None
+        self.backpressure = False
+        self.failed = False
+
+    @property
+    def fill(self):
+        return self.writer.fill if self.writer is not None else 0.
+
+    def stats(self):
+        return self.writer.stats() if self.writer is not None else None
+
+    def post_error(self, exception, code):
+        '''
+        Post error message for `exception` (once), e.g., to stop the
+        pipeline.
+        '''
+        if self.failed:
+            return
+        self.failed = True
+        error = GLib.Error.new_literal(Gst.resource_error_quark(),
+                                       'Error writing to `%s`: %s' %
+                                       (self.location, exception), code)
+        self.post_message(Gst.Message.new_error(self, error, str(exception)))
+
+    def do_start(self):
+        self.failed = False
+        try:
+            self.writer = BufferedWriter(self.location, **self.writer_kwargs)
+            self.writer.open()
+        except (IOError, OSError) as exception:
+            self.writer = None
+            self.post_error(exception, Gst.ResourceError.OPEN_WRITE)
+            return False
+        return True
+
+    def do_stop(self):
+        if self.writer is None:
+            return True
+        try:
+            self.writer.close()
+        except (IOError, OSError) as exception:
+            self.post_error(exception, Gst.ResourceError.CLOSE)
+            return False
+        return True
+
+    def do_render(self, buf):
+        try:
+            self.writer.write(buf.extract_dup(0, buf.get_size()))
+        except (IOError, OSError) as exception:
+            # Writer thread has failed.
+            self.post_error(exception, Gst.ResourceError.WRITE)
+            return Gst.FlowReturn.ERROR
+        self.update_backpressure()
+        return Gst.FlowReturn.OK
+
+    def do_event(self, event):
+        if event.type == Gst.EventType.SEGMENT:
+            segment = event.parse_segment()
+            if segment.format == Gst.Format.BYTES:
+                # e.g., muxer rewriting header.
+                self.writer.seek(segment.start)
+        elif event.type == Gst.EventType.EOS:
+            # Write all data before EOS is posted, so the file is complete
+            # once the pipeline is done.
+            try:
+                self.writer.flush(sync=self.writer.fsync != 'never')
+            except (IOError, OSError) as exception:
+                self.post_error(exception, Gst.ResourceError.WRITE)
+                return False
+        return GstBase.BaseSink.do_event(self, event)
+
+    def update_backpressure(self):
+        fill = self.writer.fill
+        if not self.backpressure and fill >= self.high_watermark:
+            self.backpressure = True
+        elif self.backpressure and fill <= self.low_watermark:
+            self.backpressure = False
+        else:
+            return
+        structure = Gst.Structure.new_empty('writer-backpressure')
+        structure.set_value('active', self.backpressure)
+        structure.set_value('fill', fill)
+        structure.set_value('location', str(self.location))
+        self.post_message(Gst.Message.new_element(self, structure))
+
+
+GObject.type_register(BufferedFileSink)